@@ -0,0 +1,124 @@
+"""
+API para uso em notebooks: acesso às tabelas e aos relatórios do banco carregado pelo
+prog.py, como relações DuckDB. As relações são preguiçosas: nada é lido até o
+resultado ser pedido, e os filtros e colunas escolhidos são levados até a leitura das
+tabelas. A conversão acontece apenas quando pedida:
+
+    import analise
+    sp = analise.escolas(anos=[2019, 2021], ufs='SP', colunas=['CODIGO_ESCOLA', 'IDEB_NOTA'])
+    sp.to_arrow_table()   # pyarrow.Table
+    sp.pl()               # polars.DataFrame (a partir do Arrow, sem cópia)
+    sp.df()               # pandas.DataFrame
+    analise.relatorio('top_cursos_enade', limite=5).to_arrow_table()
+"""
+import prog
+
+_conexao = None
+
+
+def conexao(arquivo=None):
+    """
+    Retorna a conexão somente leitura com o banco (por padrão, prog.DB_FILE), aberta
+    na primeira chamada e reaproveitada nas seguintes.
+    """
+    global _conexao
+    if arquivo is not None:
+        prog.DB_FILE = arquivo
+        if _conexao is not None:
+            _conexao.close()
+            _conexao = None
+    if _conexao is None:
+        _conexao = prog.conectar()
+    return _conexao
+
+def _lista(valor):
+    """Aceita um valor único ou uma sequência de valores; None significa sem filtro."""
+    if valor is None:
+        return None
+    if isinstance(valor, (str, int)):
+        return [valor]
+    return list(valor)
+
+def _filtrar(relacao, coluna, valores):
+    """
+    Mantém as linhas em que `coluna` está entre os valores (levado até a leitura da tabela).
+    Os valores viram literais do tipo da coluna: comparado a um VARCHAR, um ENUM como
+    SIGLA_UF seria convertido linha a linha e o filtro não usaria os zone maps.
+    """
+    valores = _lista(valores)
+    if valores is None:
+        return relacao
+    tipo = dict(zip(relacao.columns, relacao.types))[coluna]
+    if tipo.id == 'enum':
+        # Um valor fora do ENUM não casa com nenhuma linha (e um NULL na lista impediria a poda)
+        permitidos = set(dict(tipo.children)['values'])
+        valores = [valor for valor in valores if str(valor) in permitidos]
+    # Literais no SQL do filtro (e não ConstantExpression, que importa o pandas)
+    literais = [f"CAST({prog.sql_valor(valor)} AS {tipo})" for valor in valores]
+    return relacao.filter(f"{coluna} IN ({', '.join(literais)})" if literais else 'FALSE')
+
+def _tabela(con, tabela, colunas, com_municipio):
+    """
+    Relação sobre a tabela; com com_municipio (ou se NOME_MUNICIPIO for pedido), inclui
+    o nome do município, que não fica na tabela.
+    """
+    relacao = con.table(tabela)
+    if com_municipio or (colunas and 'NOME_MUNICIPIO' in colunas):
+        relacao = relacao.join(con.table('Municipio').select('ID_MUNICIPIO', 'NOME_MUNICIPIO'), 'ID_MUNICIPIO')
+    return relacao
+
+def escolas(anos=None, ufs=None, municipios=None, redes=None, colunas=None, con=None):
+    """
+    Escolas (tabela Escola), uma linha por escola e ano do IDEB/SAEB, filtradas por
+    ano, UF, nome do município e rede, com apenas as `colunas` pedidas (padrão: todas).
+    """
+    con = con or conexao()
+    relacao = _tabela(con, 'Escola', colunas, municipios is not None)
+    relacao = _filtrar(relacao, 'ANO_ESCOLA', anos)
+    relacao = _filtrar(relacao, 'SIGLA_UF', ufs)
+    relacao = _filtrar(relacao, 'NOME_MUNICIPIO', municipios)
+    relacao = _filtrar(relacao, 'REDE_ESCOLA', redes)
+    return relacao.select(*colunas) if colunas else relacao
+
+def cursos(anos=None, ufs=None, cursos=None, municipios=None, colunas=None, con=None):
+    """
+    Cursos avaliados pelo ENADE (tabela Curso), uma linha por curso, IES e ano,
+    filtrados por ano, UF, nome do curso e nome do município, com apenas as `colunas`
+    pedidas (padrão: todas).
+    """
+    con = con or conexao()
+    relacao = _tabela(con, 'Curso', colunas, municipios is not None)
+    relacao = _filtrar(relacao, 'ANO_ENADE', anos)
+    relacao = _filtrar(relacao, 'SIGLA_UF', ufs)
+    relacao = _filtrar(relacao, 'NOME_CURSO', cursos)
+    relacao = _filtrar(relacao, 'NOME_MUNICIPIO', municipios)
+    return relacao.select(*colunas) if colunas else relacao
+
+def municipios(ufs=None, nomes=None, colunas=None, con=None):
+    """Municípios (tabela Municipio), filtrados por UF e nome."""
+    con = con or conexao()
+    relacao = _filtrar(con.table('Municipio'), 'SIGLA_UF', ufs)
+    relacao = _filtrar(relacao, 'NOME_MUNICIPIO', nomes)
+    return relacao.select(*colunas) if colunas else relacao
+
+def consultas():
+    """Nomes dos relatórios disponíveis e seus parâmetros, com os valores padrão."""
+    return {consulta['nome']: dict(consulta.get('parametros', {})) for consulta in prog.CONSULTAS}
+
+def relatorio(nome, usar_cache=True, aproximado=False, con=None, **parametros):
+    """
+    Resultado de um relatório do registro prog.CONSULTAS, com os parâmetros informados
+    (ex.: relatorio('top_cursos_enade', limite=5, ano_inicio=2022)). Com usar_cache, o
+    resultado vem do cache de consultas do prog.py (ver prog.relacao_consulta); sem ele,
+    a consulta é executada em streaming a cada leitura. Com aproximado, usa a variante
+    aproximada do relatório, se houver (ver prog.sql_consulta).
+    """
+    consulta = next((c for c in prog.CONSULTAS if c['nome'] == nome), None)
+    if consulta is None:
+        raise KeyError(f"Consulta desconhecida: {nome} (disponíveis: {', '.join(consultas())})")
+    desconhecidos = set(parametros) - set(consulta.get('parametros', {}))
+    if desconhecidos:
+        raise TypeError(f"Parâmetros não usados pela consulta {nome}: {', '.join(sorted(desconhecidos))}")
+    con = con or conexao()
+    sql = prog.sql_consulta(consulta, aproximado)
+    return prog.relacao_consulta(con, sql, prog.parametros_consulta(consulta, parametros), usar_cache)
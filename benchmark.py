@@ -0,0 +1,191 @@
+import duckdb
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import gerar_dados
+import prog
+
+# --- Configuração ---
+PATH_BENCH = 'bench/'
+ESCALAS = [1, 10]
+# Crescimento máximo do pico de RSS da carga entre as duas maiores escalas quando ela é
+# em streaming com --limite-memoria (ver verificar_memoria_plana)
+TOLERANCIA_PICO = 0.25
+
+
+def configurar_prog(diretorio):
+    """Aponta o prog para os arquivos e o banco gerados em `diretorio`."""
+    prog.ARQUIVOS_ENADE = sorted(glob.glob(os.path.join(diretorio, 'conceito_enade_*.csv')))
+    prog.ARQUIVO_IDEB = glob.glob(os.path.join(diretorio, 'ideb_saeb_*.csv'))[0]
+    prog.DB_FILE = os.path.join(diretorio, 'database.duckdb')
+    prog.PATH_CACHE_STAGING = os.path.join(diretorio, 'cache', 'staging', '')
+    prog.PATH_CACHE_CONSULTAS = os.path.join(diretorio, 'cache', 'consultas', '')
+
+def medir_etapa(diretorio, etapa, opcoes, fila):
+    """
+    Executa uma etapa em um processo próprio e coloca na fila o tempo de parede, o tempo
+    de CPU, o pico de RSS e as linhas. O pico é o VmHWM do processo (ver
+    prog.pico_memoria_mb): o ru_maxrss de um processo criado por spawn traria o pico do
+    processo pai, que gera os dados. Na carga, entram também as subetapas medidas por
+    carregar_dados (leitura, staging, inserções, agregados, commit).
+    """
+    configurar_prog(diretorio)
+    # A importação do pandas (usado por .df()) fica fora da medição
+    import pandas  # noqa: F401
+    inicio, inicio_cpu = time.perf_counter(), time.process_time()
+    subetapas = None
+    if etapa in ('carga', 'carga_incremental'):
+        incremental = etapa == 'carga_incremental'
+        con = duckdb.connect(prog.DB_FILE)
+        if opcoes.get('limite_memoria'):
+            con.execute(f"SET memory_limit = {prog.sql_texto(opcoes['limite_memoria'])};")
+        prog.criar_tabelas(con, recriar=not incremental)
+        subetapas = []
+        prog.carregar_dados(con, incremental=incremental, tamanho_lote=opcoes['tamanho_lote'],
+                            processos=opcoes['processos'], usar_cache=False, perfil=subetapas)
+        linhas = sum(con.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0] for tabela in ('Escola', 'Curso'))
+    elif etapa in ('relatorio', 'relatorio_aproximado'):
+        con = duckdb.connect(prog.DB_FILE, read_only=True)
+        relatorio = prog.executar_relatorio(con, usar_cache=False, aproximado=etapa == 'relatorio_aproximado')
+        linhas = sum(len(resultado) for _, resultado in relatorio)
+    else:
+        consulta = next(c for c in prog.CONSULTAS if c['nome'] == etapa)
+        con = duckdb.connect(prog.DB_FILE, read_only=True)
+        linhas = len(prog.executar_consulta(con, consulta['sql'], prog.parametros_consulta(consulta), usar_cache=False))
+    con.close()
+    medida = {
+        'etapa': etapa,
+        'segundos': round(time.perf_counter() - inicio, 4),
+        'cpu_segundos': round(time.process_time() - inicio_cpu, 4),
+        'pico_rss_mb': round(prog.pico_memoria_mb() or 0, 1),
+        'linhas': linhas,
+    }
+    if subetapas is not None:
+        medida['subetapas'] = subetapas
+    fila.put(medida)
+
+def executar_etapa(diretorio, etapa, opcoes):
+    """Roda medir_etapa em um processo novo e retorna suas medidas."""
+    contexto = multiprocessing.get_context('spawn')
+    fila = contexto.Queue()
+    processo = contexto.Process(target=medir_etapa, args=(diretorio, etapa, opcoes, fila))
+    processo.start()
+    processo.join()
+    if processo.exitcode != 0:
+        raise RuntimeError(f"A etapa '{etapa}' falhou (código de saída {processo.exitcode}).")
+    return fila.get()
+
+def verificar_memoria_plana(relatorio, tolerancia=TOLERANCIA_PICO):
+    """
+    Compara o pico de RSS da carga completa nas duas maiores escalas do relatório: na
+    carga em streaming com limite de memória ele deve ficar estável (crescer no máximo
+    `tolerancia`) quando os dados crescem. Nas escalas menores o pico ainda cresce até o
+    limite; sem limite, o DuckDB guarda páginas em cache até 80% da RAM. Retorna o
+    resultado da verificação, ou None se não se aplica.
+    """
+    opcoes = relatorio['opcoes']
+    if not (opcoes['tamanho_lote'] and opcoes['limite_memoria']) or len(relatorio['escalas']) < 2:
+        return None
+    menor, maior = sorted(relatorio['escalas'], key=lambda e: e['escala'])[-2:]
+    picos = [next(m['pico_rss_mb'] for m in e['etapas'] if m['etapa'] == 'carga') for e in (menor, maior)]
+    crescimento = picos[1] / picos[0] - 1
+    return {
+        'escalas': [menor['escala'], maior['escala']],
+        'pico_rss_mb': picos,
+        'crescimento': round(crescimento, 4),
+        'tolerancia': tolerancia,
+        'ok': crescimento <= tolerancia,
+    }
+
+def executar(escalas=ESCALAS, destino=PATH_BENCH, repeticoes=3, tamanho_lote=None, processos=None, regerar=False,
+             limite_memoria=None):
+    """
+    Para cada escala: gera os dados sintéticos (se ainda não existirem), mede a carga
+    completa, a carga incremental sem alterações, cada consulta do relatório e o
+    relatório inteiro, exato e aproximado, com as consultas em paralelo (melhor tempo
+    de `repeticoes` execuções, sem o cache de consultas). Com `tamanho_lote` e
+    `limite_memoria`, verifica ao final que o pico da carga não cresce com a escala
+    (ver verificar_memoria_plana). Retorna o relatório.
+    """
+    opcoes = {'tamanho_lote': tamanho_lote, 'processos': processos, 'limite_memoria': limite_memoria}
+    relatorio = {
+        'gerado_em': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'duckdb': duckdb.__version__,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+        'opcoes': opcoes,
+        'escalas': [],
+    }
+    for escala in escalas:
+        diretorio = os.path.join(destino, f'escala_{escala:g}')
+        if regerar and os.path.isdir(diretorio):
+            shutil.rmtree(diretorio)
+        inicio = time.perf_counter()
+        if not glob.glob(os.path.join(diretorio, 'ideb_saeb_*.csv')):
+            gerar_dados.gerar(diretorio, escala)
+        geracao = round(time.perf_counter() - inicio, 4)
+
+        for arquivo in glob.glob(os.path.join(diretorio, 'database.duckdb*')):
+            os.remove(arquivo)
+        etapas = [executar_etapa(diretorio, 'carga', opcoes), executar_etapa(diretorio, 'carga_incremental', opcoes)]
+        for nome in [c['nome'] for c in prog.CONSULTAS] + ['relatorio', 'relatorio_aproximado']:
+            medidas = [executar_etapa(diretorio, nome, opcoes) for _ in range(repeticoes)]
+            etapas.append(min(medidas, key=lambda m: m['segundos']))
+        for medida in etapas:
+            print(f"escala {escala:>6g}  {medida['etapa']:<28} {medida['segundos']:>9.3f} s "
+                  f"{medida['cpu_segundos']:>9.3f} s CPU {medida['pico_rss_mb']:>9.1f} MB {medida['linhas']:>10} linhas")
+            for sub in medida.get('subetapas', []):
+                print(f"escala {escala:>6g}    {sub['etapa']:<26} {sub['segundos']:>9.3f} s "
+                      f"{sub['cpu_segundos']:>9.3f} s CPU {sub['pico_rss_mb'] or 0:>9.1f} MB")
+
+        relatorio['escalas'].append({
+            'escala': escala,
+            'geracao_segundos': geracao,
+            'arquivos': {os.path.basename(a): os.path.getsize(a) for a in sorted(glob.glob(os.path.join(diretorio, '*.csv')))},
+            'banco_bytes': os.path.getsize(os.path.join(diretorio, 'database.duckdb')),
+            'etapas': etapas,
+        })
+
+    relatorio['memoria_plana'] = verificar_memoria_plana(relatorio)
+    if relatorio['memoria_plana']:
+        verificacao = relatorio['memoria_plana']
+        print(f"Pico da carga: {verificacao['pico_rss_mb'][0]:.1f} MB na escala {verificacao['escalas'][0]:g}, "
+              f"{verificacao['pico_rss_mb'][1]:.1f} MB na escala {verificacao['escalas'][1]:g} "
+              f"({verificacao['crescimento']:+.1%}, tolerância {verificacao['tolerancia']:.0%}): "
+              f"{'estável' if verificacao['ok'] else 'CRESCEU'}")
+    return relatorio
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mede a carga e as consultas do prog.py sobre dados sintéticos em várias escalas.")
+    parser.add_argument('--escalas', type=float, nargs='+', default=ESCALAS, help=f"fatores de escala (padrão: {ESCALAS})")
+    parser.add_argument('--destino', default=PATH_BENCH, help=f"diretório dos dados e bancos gerados (padrão: {PATH_BENCH})")
+    parser.add_argument('--saida', help="arquivo JSON com os resultados (padrão: <destino>/resultado.json)")
+    parser.add_argument('--repeticoes', type=int, default=3, help="execuções de cada consulta (vale a mais rápida)")
+    parser.add_argument('--tamanho-lote', type=int, help="carrega o IDEB/SAEB em streaming com lotes deste tamanho")
+    parser.add_argument('--processos', type=int, help="processos para ler os arquivos ENADE")
+    parser.add_argument('--limite-memoria', help="memory_limit do DuckDB na carga (ex.: 300MB); com --tamanho-lote, "
+                                                 "verifica que o pico da carga fica estável entre as duas maiores escalas")
+    parser.add_argument('--regerar', action='store_true', help="gera os dados de novo mesmo se já existirem")
+    args = parser.parse_args(argv)
+
+    relatorio = executar(args.escalas, args.destino, args.repeticoes, args.tamanho_lote, args.processos, args.regerar,
+                         args.limite_memoria)
+    saida = args.saida or os.path.join(args.destino, 'resultado.json')
+    os.makedirs(os.path.dirname(saida) or '.', exist_ok=True)
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2)
+    print(f"Resultados gravados em {saida}")
+    if relatorio['memoria_plana'] and not relatorio['memoria_plana']['ok']:
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import duckdb
+import argparse
+import math
+import os
+import re
+
+from prog import find_column_name, sql_coluna, sql_read_csv, sql_texto
+
+# --- Configuração ---
+PATH_MODELOS = 'data/'
+PATH_SAIDA = 'dados_sinteticos/'
+ANOS_ENADE = [2021, 2022, 2023]
+ANOS_IDEB = [2017, 2019, 2021, 2023]
+# Escolas no arquivo IDEB/SAEB na escala 1x
+ESCOLAS_POR_ESCALA = 40_000
+# Fração das notas de um ano ausentes ('-') no IDEB/SAEB
+FRACAO_AUSENTES_IDEB = 0.15
+# Rodapé do arquivo IDEB/SAEB (14 linhas), como nas planilhas do INEP exportadas para CSV
+RODAPE_IDEB = [
+    'Fonte: MEC/Inep.',
+    'Notas:',
+    '(1) Os resultados marcados com * não atingiram 80% de participação no SAEB.',
+    '(2) Resultados do IDEB e do SAEB calculados a partir das escolas com 10 ou mais alunos participantes.',
+    '(3) Taxa de aprovação calculada com base nas informações prestadas ao Censo Escolar.',
+    '(4) As notas padronizadas do SAEB variam de 0 a 10, com base na Prova Brasil.',
+    '(5) "-" Sem média no SAEB: não participou, não atendeu aos requisitos ou não houve divulgação.',
+    '(6) Escolas sem código válido ou extintas foram excluídas.',
+    '(7) Rede: Estadual, Municipal ou Federal.',
+    '(8) Dados sujeitos a revisão, conforme Portaria Inep.',
+    '(9) Metas projetadas a partir do IDEB de 2005.',
+    '(10) Informações consolidadas por escola, município e UF.',
+    'Elaboração: Diretoria de Estatísticas Educacionais, Deed/Inep',
+    'Atualizado em: consulta ao portal do Inep',
+]
+
+
+def ruido(*partes):
+    """
+    Expressão SQL com um valor pseudoaleatório em [-1, 1], determinístico para as
+    partes informadas (independe da ordem de execução e do número de threads).
+    """
+    return f"((hash({', '.join(partes)}) % 20001)::DOUBLE / 10000 - 1)"
+
+def sql_decimal(expressao, casas):
+    """Formata uma expressão numérica com vírgula decimal, como nos arquivos de origem."""
+    return f"replace(printf('%.{casas}f', {expressao}), '.', ',')"
+
+def converter_latin1(origem, destino, rodape=()):
+    """
+    Copia o CSV `origem` (UTF-8, escrito pelo DuckDB) para `destino` em latin1,
+    em blocos, acrescentando as linhas de `rodape`. Remove `origem` ao final.
+    """
+    with open(origem, encoding='utf-8', newline='') as entrada, \
+            open(destino, 'w', encoding='latin-1', errors='replace', newline='') as saida:
+        for bloco in iter(lambda: entrada.read(1 << 24), ''):
+            saida.write(bloco)
+        for linha in rodape:
+            saida.write(linha + '\n')
+    os.remove(origem)
+
+def rodape_enade(modelo):
+    """Linhas finais do arquivo ENADE `modelo` que não são dados (notas e observações)."""
+    with open(modelo, encoding='latin-1', newline='') as f:
+        linhas = f.read().splitlines()
+    inicio = len(linhas)
+    while inicio > 1 and not re.match(r'\d{4},', linhas[inicio - 1]):
+        inicio -= 1
+    return linhas[inicio:]
+
+def gerar_enade(con, modelo, destino, ano, escala):
+    """
+    Gera um arquivo ENADE do ano informado com escala vezes o número de linhas de dados
+    do arquivo `modelo`. Cada réplica k repete as linhas do modelo (mesmos cursos,
+    municípios, faixas 'SC' e notas ausentes) como uma nova IES (código + k * 1000000),
+    com as notas perturbadas; a réplica 0 é o próprio modelo. O rodapé do modelo é
+    mantido no final do arquivo.
+    """
+    con.execute(f'''
+        CREATE OR REPLACE TEMP TABLE modelo_enade AS
+        SELECT * EXCLUDE (filename), ROW_NUMBER() OVER () AS LINHA_MODELO
+        FROM {sql_read_csv([modelo])};
+    ''')
+    colunas = [c for c in (linha[0] for linha in con.execute("DESCRIBE modelo_enade").fetchall()) if c != 'LINHA_MODELO']
+    con.execute(f"DELETE FROM modelo_enade WHERE TRY_CAST({sql_coluna(find_column_name(colunas, 'Ano'))} AS INTEGER) IS NULL;")
+    n_modelo = con.execute("SELECT COUNT(*) FROM modelo_enade").fetchone()[0]
+    n = max(1, round(n_modelo * escala))
+
+    def coluna(nome):
+        return sql_coluna(find_column_name(colunas, nome))
+
+    def numero(nome):
+        return f"TRY_CAST(REPLACE({coluna(nome)}, ',', '.') AS DOUBLE)"
+
+    # Valores não numéricos (vazios, '#N/D') são mantidos como no modelo
+    continua = f"LEAST(5, GREATEST(0, {numero('Conceito Enade (Contínuo)')} + 0.3 * {ruido('k', 'LINHA_MODELO', sql_texto('continua'))}))"
+    perturbadas = {
+        find_column_name(colunas, 'Ano'): str(ano),
+        find_column_name(colunas, 'Código da IES'):
+            f"CASE WHEN k = 0 THEN {coluna('Código da IES')} ELSE (TRY_CAST({coluna('Código da IES')} AS BIGINT) + k * 1000000)::VARCHAR END",
+        find_column_name(colunas, 'Nome da IES'):
+            f"CASE WHEN k = 0 THEN {coluna('Nome da IES')} ELSE {coluna('Nome da IES')} || ' - UNIDADE ' || k END",
+        find_column_name(colunas, 'Código do Curso'):
+            f"CASE WHEN k = 0 THEN {coluna('Código do Curso')} ELSE (TRY_CAST({coluna('Código do Curso')} AS BIGINT) + k * 10000000)::VARCHAR END",
+        find_column_name(colunas, 'Conceito Enade (Contínuo)'):
+            f"CASE WHEN k = 0 OR {numero('Conceito Enade (Contínuo)')} IS NULL THEN {coluna('Conceito Enade (Contínuo)')}"
+            f" ELSE {sql_decimal(continua, 3)} END",
+        find_column_name(colunas, 'Conceito Enade (Faixa)'):
+            f"CASE WHEN k = 0 OR {numero('Conceito Enade (Contínuo)')} IS NULL OR {coluna('Conceito Enade (Faixa)')} = 'SC'"
+            f" THEN {coluna('Conceito Enade (Faixa)')} ELSE LEAST(5, FLOOR({continua} + 0.055) + 1)::INTEGER::VARCHAR END",
+    }
+    # Notas brutas (0 a 100) e padronizadas (0 a 5) variam até 10%
+    for nome, maximo in [('Nota Bruta - FG', 100), ('Nota Padronizada - FG', 5),
+                         ('Nota Bruta - CE', 100), ('Nota Padronizada - CE', 5)]:
+        valor = f"LEAST({maximo}, GREATEST(0, {numero(nome)} * (1 + 0.1 * {ruido('k', 'LINHA_MODELO', sql_texto(nome))})))"
+        perturbadas[find_column_name(colunas, nome)] = \
+            f"CASE WHEN k = 0 OR {numero(nome)} IS NULL THEN {coluna(nome)} ELSE {sql_decimal(valor, 3)} END"
+
+    selecao = ', '.join(f"{perturbadas.get(c, sql_coluna(c))} AS {sql_coluna(c)}" for c in colunas)
+    temporario = f'{destino}.{os.getpid()}.tmp'
+    con.execute(f'''
+        COPY (
+            SELECT {selecao}
+            FROM range({math.ceil(n / n_modelo)}) AS r(k) CROSS JOIN modelo_enade
+            ORDER BY k, LINHA_MODELO
+            LIMIT {n}
+        ) TO {sql_texto(temporario)} (FORMAT csv, HEADER true, DELIMITER ',');
+    ''')
+    converter_latin1(temporario, destino, rodape_enade(modelo))
+    con.execute("DROP TABLE modelo_enade;")
+    return n
+
+def gerar_ideb(con, modelos, destino, anos, escala):
+    """
+    Gera o arquivo IDEB/SAEB (formato largo, uma linha por escola) com escala vezes
+    ESCOLAS_POR_ESCALA escolas, distribuídas pelos municípios dos arquivos ENADE
+    `modelos`. Cada escola tem um nível próprio e notas por ano em torno dele; uma
+    fração das notas fica ausente ('-'). O arquivo termina com o rodapé RODAPE_IDEB.
+    """
+    con.execute(f'''
+        CREATE OR REPLACE TEMP TABLE municipios_modelo AS
+        SELECT ROW_NUMBER() OVER (ORDER BY uf, codigo, nome) - 1 AS IDX, *
+        FROM (
+            SELECT DISTINCT "Sigla da UF" AS uf, "Código do Município" AS codigo, "Município do Curso" AS nome
+            FROM {sql_read_csv(modelos)}
+            WHERE "Sigla da UF" IS NOT NULL AND "Município do Curso" IS NOT NULL
+        );
+    ''')
+    n_municipios = con.execute("SELECT COUNT(*) FROM municipios_modelo").fetchone()[0]
+    n = max(1, round(ESCOLAS_POR_ESCALA * escala))
+
+    nivel = f"(4.5 + 2 * {ruido('i', sql_texto('nivel'))})"
+    notas = []
+    for j, ano in enumerate(anos):
+        ausente = f"hash(i, {ano}, 'ausente') % 10000 < {int(FRACAO_AUSENTES_IDEB * 10000)}"
+        valores = {
+            f'Nota_SAEB_{ano}_Mat': (f"200 + 10 * {nivel} + 15 * {ruido('i', str(ano), sql_texto('mat'))}", 2),
+            f'Nota_SAEB_{ano}_Port': (f"190 + 10 * {nivel} + 15 * {ruido('i', str(ano), sql_texto('port'))}", 2),
+            f'Nota_padronizada_SAEB_{ano}': (f"LEAST(10, GREATEST(0, {nivel} + 0.5 + 0.4 * {ruido('i', str(ano), sql_texto('pad'))}))", 2),
+            f'Nota_ideb_{ano}': (f"LEAST(10, GREATEST(0, {nivel} + {0.1 * j} + 0.5 * {ruido('i', str(ano), sql_texto('ideb'))}))", 1),
+        }
+        notas += [f"CASE WHEN {ausente} THEN '-' ELSE {sql_decimal(expr, casas)} END AS {sql_coluna(nome)}"
+                  for nome, (expr, casas) in valores.items()]
+
+    temporario = f'{destino}.{os.getpid()}.tmp'
+    con.execute(f'''
+        COPY (
+            SELECT
+                m.uf AS "Sigla da UF",
+                m.codigo AS "Código do Município",
+                m.nome AS "Nome do Município",
+                (11000000 + i)::VARCHAR AS "Código da Escola",
+                ['ESCOLA ESTADUAL', 'ESCOLA MUNICIPAL', 'ESCOLA FEDERAL'][rede] || ' ' || i AS "Nome da Escola",
+                ['Estadual', 'Municipal', 'Federal'][rede] AS "Rede",
+                {', '.join(notas)}
+            FROM (
+                SELECT i, hash(i, 'municipio') % {n_municipios} AS IDX,
+                       CASE WHEN hash(i, 'rede') % 100 < 2 THEN 3 WHEN hash(i, 'rede') % 100 < 45 THEN 1 ELSE 2 END AS rede
+                FROM range({n}) AS r(i)
+            ) e
+            JOIN municipios_modelo m USING (IDX)
+            ORDER BY i
+        ) TO {sql_texto(temporario)} (FORMAT csv, HEADER true, DELIMITER ',');
+    ''')
+    converter_latin1(temporario, destino, RODAPE_IDEB)
+    con.execute("DROP TABLE municipios_modelo;")
+    return n
+
+def gerar(destino=PATH_SAIDA, escala=1, anos_enade=ANOS_ENADE, anos_ideb=ANOS_IDEB, modelos=None):
+    """
+    Gera em `destino` os arquivos ENADE (conceito_enade_<ano>.csv) e IDEB/SAEB
+    (ideb_saeb_<anos>.csv) na escala informada, com os modelos ENADE de PATH_MODELOS
+    usados em rodízio pelos anos. Retorna {caminho: número de linhas de dados}.
+    """
+    modelos = modelos or sorted(
+        os.path.join(PATH_MODELOS, f) for f in os.listdir(PATH_MODELOS) if f.startswith('conceito_enade_') and f.endswith('.csv')
+    )
+    if not modelos:
+        raise FileNotFoundError(f"Nenhum arquivo ENADE de modelo encontrado em {PATH_MODELOS}")
+    os.makedirs(destino, exist_ok=True)
+    con = duckdb.connect()
+    gerados = {}
+    for i, ano in enumerate(sorted(anos_enade)):
+        arquivo = os.path.join(destino, f'conceito_enade_{ano}.csv')
+        gerados[arquivo] = gerar_enade(con, modelos[i % len(modelos)], arquivo, ano, escala)
+    arquivo = os.path.join(destino, f"ideb_saeb_{'_'.join(str(a) for a in sorted(anos_ideb))}.csv")
+    gerados[arquivo] = gerar_ideb(con, modelos, arquivo, sorted(anos_ideb), escala)
+    con.close()
+    return gerados
+
+def main():
+    parser = argparse.ArgumentParser(description="Gera arquivos ENADE e IDEB/SAEB sintéticos em escala, no formato dos arquivos de origem.")
+    parser.add_argument('--escala', type=float, default=1,
+                        help="fator de escala (1 = tamanho dos arquivos reais; ex.: 10, 100, 1000)")
+    parser.add_argument('--destino', default=PATH_SAIDA, help=f"diretório de saída (padrão: {PATH_SAIDA})")
+    parser.add_argument('--anos-enade', type=int, nargs='+', default=ANOS_ENADE, help="anos dos arquivos ENADE")
+    parser.add_argument('--anos-ideb', type=int, nargs='+', default=ANOS_IDEB, help="anos das notas do IDEB/SAEB")
+    args = parser.parse_args()
+
+    for arquivo, linhas in gerar(args.destino, args.escala, args.anos_enade, args.anos_ideb).items():
+        print(f"{arquivo}: {linhas} linhas, {os.path.getsize(arquivo) / (1 << 20):.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -1,84 +1,168 @@
 import duckdb
-import pandas as pd
-import numpy as np
+import argparse
+import glob
+import hashlib
+import json
+import os
 import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
 
 # --- Configuração ---
 PATH_DADOS = 'data/'
-ARQUIVOS_ENADE = [
-    f'{PATH_DADOS}conceito_enade_2021.csv',
-    f'{PATH_DADOS}conceito_enade_2022.csv',
-    f'{PATH_DADOS}conceito_enade_2023.csv'
-]
+# Um arquivo por ano; novos anos (ex.: conceito_enade_2024.csv) são incluídos automaticamente
+ARQUIVOS_ENADE = sorted(glob.glob(f'{PATH_DADOS}conceito_enade_*.csv'))
 ARQUIVO_IDEB = f'{PATH_DADOS}ideb_saeb_2017_2019_2021_2023.csv'
 DB_FILE = 'database.duckdb'
+# Cache de staging: dados de origem já limpos, em Parquet, um arquivo por versão (hash) da
+# origem e das regras de validação
+PATH_CACHE_STAGING = 'cache/staging/'
+# Versão do formato do staging; alterá-la invalida os caches gravados com o formato anterior
+VERSAO_STAGING = 3
+# Cache de resultados das consultas (Parquet), com descarte LRU acima do tamanho máximo
+PATH_CACHE_CONSULTAS = 'cache/consultas/'
+TAMANHO_CACHE_CONSULTAS = 64 * 1024 * 1024
+# Relatório de execução gravado com --perfil (etapas da carga e consultas)
+ARQUIVO_PERFIL = 'perfil_execucao.json'
+# Banco em memória, com compressão, das tabelas intermediárias da carga (stg_escola e
+# stg_curso): dicionário/FSST nos textos, bit-packing nos inteiros e ALP nas notas
+BANCO_STAGING = 'etl'
+# Colunas de controle das linhas de staging, fora de Escola e Curso: arquivo e posição de
+# origem, motivo da rejeição (NULL nas linhas válidas) e registro original das rejeitadas
+COLUNAS_CONTROLE = 'ARQUIVO, LINHA, MOTIVO, REGISTRO'
+# Faixas válidas das notas na validação da carga; notas fora delas levam a linha para Rejeitados
+LIMITES_NOTAS = {
+    'IDEB_NOTA': (0, 10), 'SAEB_NOTA_MAT': (0, 500), 'SAEB_NOTA_PORT': (0, 500), 'SAEB_NOTA_PADRAO': (0, 10),
+    'NOTA_BRUTA_CE': (0, 100), 'NOTA_BRUTA_FG': (0, 100), 'NOTA_PADRONIZADA_CE': (0, 5),
+    'NOTA_PADRONIZADA_FG': (0, 5), 'NOTA_ENADE_CONTINUA': (0, 5), 'NOTA_ENADE_FAIXA': (1, 5),
+}
+# Registros por lote na carga em streaming do IDEB/SAEB (--streaming)
+TAMANHO_LOTE_IDEB = 100_000
+# Exportação dos resultados: formato pela extensão do destino, linhas por lote
+# (Arrow IPC) e por página (txt)
+FORMATOS_EXPORTACAO = {'.parquet': 'parquet', '.csv': 'csv', '.arrow': 'arrow', '.arrows': 'arrow', '.ipc': 'arrow', '.txt': 'txt'}
+TAMANHO_LOTE_EXPORTACAO = 100_000
+TAMANHO_PAGINA_TXT = 50_000
+# Ordem em que Escola e Curso são gravadas (ano, UF, município): as linhas de cada
+# fatia ficam em poucos row groups, e o DuckDB pula os demais pelos zone maps (min/max)
+ORDEM_ESCOLA = 'ANO_ESCOLA, SIGLA_UF, ID_MUNICIPIO'
+ORDEM_CURSO = 'ANO_ENADE, SIGLA_UF, ID_MUNICIPIO'
+# Lago Parquet opcional (--lago), uma versão por carga (lago/<data e hora>/escola/ano=/uf=/...),
+# exposto como as views LagoEscola e LagoCurso
+PATH_LAGO = 'lago/'
+# Carga azul/verde (--sombra): banco sombra, cópias dos bancos substituídos, por quantos
+# dias são mantidas e redução máxima aceita no número de linhas de uma tabela
+PATH_SNAPSHOTS = 'snapshots/'
+RETENCAO_SNAPSHOTS_DIAS = 7
+REDUCAO_MAXIMA_LINHAS = 0.5
+# Tabelas de agregados mantidas pela carga e usadas pelos relatórios
+AGREGADOS = ['AgregadoUfAno', 'HistogramaIdeb', 'AgregadoEscola', 'AmostraEscola', 'AgregadoCursoAno', 'AgregadoCategoriaIes']
+# Modo aproximado (--aproximado): fração das escolas de cada UF em AmostraEscola, com um
+# mínimo de escolas por UF (todas, se a UF tiver menos), escolhidas pela ordem do hash do
+# código, e erro relativo (desvio padrão) do approx_count_distinct do DuckDB (HyperLogLog),
+# medido em contagens de 100 a 10^6
+FRACAO_AMOSTRA = 0.05
+AMOSTRA_MINIMA_UF = 30
+ERRO_RELATIVO_HLL = 0.13
 
 
-def get_uf_full_name(sigla : str) -> str:
-    if not isinstance(sigla, str):
-        raise TypeError("sigla em get_uf_full_name(sigla) deve ser do tipo str")
-
-    uf_dict = {
-        'AC': 'Acre',
-        'AL': 'Alagoas',
-        'AP': 'Amapá',
-        'AM': 'Amazonas',
-        'BA': 'Bahia',
-        'CE': 'Ceará',
-        'DF': 'Distrito Federal',
-        'ES': 'Espírito Santo',
-        'GO': 'Goiás',
-        'MA': 'Maranhão',
-        'MT': 'Mato Grosso',
-        'MS': 'Mato Grosso do Sul',
-        'MG': 'Minas Gerais',
-        'PA': 'Pará',
-        'PB': 'Paraíba',
-        'PR': 'Paraná',
-        'PE': 'Pernambuco',
-        'PI': 'Piauí',
-        'RJ': 'Rio de Janeiro',
-        'RN': 'Rio Grande do Norte',
-        'RS': 'Rio Grande do Sul',
-        'RO': 'Rondônia',
-        'RR': 'Roraima',
-        'SC': 'Santa Catarina',
-        'SP': 'São Paulo',
-        'SE': 'Sergipe',
-        'TO': 'Tocantins'
-    }
-    
-    key = sigla.strip().upper()
-    try:
-        return uf_dict[key]
-    except KeyError:
-        raise ValueError(f"Sigla não contida em uf_dict: {sigla}")
-
+UF_NOMES = {
+    'AC': 'Acre',
+    'AL': 'Alagoas',
+    'AP': 'Amapá',
+    'AM': 'Amazonas',
+    'BA': 'Bahia',
+    'CE': 'Ceará',
+    'DF': 'Distrito Federal',
+    'ES': 'Espírito Santo',
+    'GO': 'Goiás',
+    'MA': 'Maranhão',
+    'MT': 'Mato Grosso',
+    'MS': 'Mato Grosso do Sul',
+    'MG': 'Minas Gerais',
+    'PA': 'Pará',
+    'PB': 'Paraíba',
+    'PR': 'Paraná',
+    'PE': 'Pernambuco',
+    'PI': 'Piauí',
+    'RJ': 'Rio de Janeiro',
+    'RN': 'Rio Grande do Norte',
+    'RS': 'Rio Grande do Sul',
+    'RO': 'Rondônia',
+    'RR': 'Roraima',
+    'SC': 'Santa Catarina',
+    'SP': 'São Paulo',
+    'SE': 'Sergipe',
+    'TO': 'Tocantins'
+}
 
 
-def criar_tabelas(con):
+def criar_tabelas(con, recriar=True):
     """
     Cria as tabelas Municipio, Escola e Curso no banco de dados DuckDB
-    usando exatamente o schema fornecido pelo usuário.
+    usando exatamente o schema fornecido pelo usuário, além da tabela
+    ManifestoCarga, que registra os arquivos de origem já carregados, e Rejeitados, com
+    as linhas de origem recusadas pela validação da carga e o motivo de cada uma.
+    Com recriar=False as tabelas existentes são mantidas (carga incremental), a menos
+    que estejam no schema antigo, sem as chaves inteiras de município ou sem as tabelas
+    de agregados.
+
+    Municipio é identificada por ID_MUNICIPIO: o código IBGE do município quando a
+    origem o informa (ENADE) ou, caso contrário (IDEB), um código sequencial a partir
+    de 10000000, fora da faixa dos códigos IBGE. A restrição UNIQUE (SIGLA_UF,
+    NOME_MUNICIPIO) serve de índice nome -> código para as linhas sem código.
+    SIGLA_UF e NOME_UF usam tipos ENUM.
+
+    As tabelas Agregado* e HistogramaIdeb guardam estatísticas parciais e combináveis
+    (somas, contagens, mínimos/máximos, histogramas e conjuntos) por grupo, mantidas
+    pela carga (ver atualizar_agregados) e usadas pelos relatórios. AmostraEscola é
+    uma amostra de AgregadoEscola, usada pelas consultas no modo aproximado.
     """
-    # Usa 'DROP TABLE IF EXISTS' para garantir que o script possa ser executado várias vezes
-    con.execute("DROP TABLE IF EXISTS Curso;")
-    con.execute("DROP TABLE IF EXISTS Escola;")
-    con.execute("DROP TABLE IF EXISTS Municipio;")
-    
+    schema_antigo = con.execute('''
+        SELECT COUNT(*) FILTER (WHERE table_name = 'Municipio') > 0
+           AND (COUNT(*) FILTER (WHERE table_name = 'Municipio' AND column_name = 'ID_MUNICIPIO') = 0
+                OR COUNT(*) FILTER (WHERE table_name = 'AgregadoUfAno') = 0
+                OR COUNT(*) FILTER (WHERE table_name = 'AmostraEscola') = 0)
+        FROM information_schema.columns
+    ''').fetchone()[0]
+    if recriar or schema_antigo:
+        # Usa 'DROP TABLE IF EXISTS' para garantir que o script possa ser executado várias vezes
+        for tabela in AGREGADOS:
+            con.execute(f"DROP TABLE IF EXISTS {tabela};")
+        con.execute("DROP TABLE IF EXISTS ManifestoCarga;")
+        con.execute("DROP TABLE IF EXISTS Rejeitados;")
+        con.execute("DROP TABLE IF EXISTS Curso;")
+        con.execute("DROP TABLE IF EXISTS Escola;")
+        con.execute("DROP TABLE IF EXISTS Municipio;")
+        con.execute("DROP SEQUENCE IF EXISTS seq_municipio;")
+        con.execute("DROP TYPE IF EXISTS SIGLA_UF_T;")
+        con.execute("DROP TYPE IF EXISTS NOME_UF_T;")
+
+    # Tipos ENUM das UFs e sequência dos municípios sem código IBGE
+    if not con.execute("SELECT COUNT(*) FROM duckdb_types() WHERE type_name ILIKE 'SIGLA_UF_T'").fetchone()[0]:
+        con.execute(f"CREATE TYPE SIGLA_UF_T AS ENUM ({', '.join(sql_texto(s) for s in UF_NOMES)});")
+        con.execute(f"CREATE TYPE NOME_UF_T AS ENUM ({', '.join(sql_texto(n) for n in UF_NOMES.values())});")
+    con.execute("CREATE SEQUENCE IF NOT EXISTS seq_municipio START 10000000;")
+
     # Criação da tabela Municipio
     con.execute('''
-        CREATE TABLE Municipio (
-            SIGLA_UF VARCHAR(2),
-            NOME_UF VARCHAR(50),
+        CREATE TABLE IF NOT EXISTS Municipio (
+            ID_MUNICIPIO INTEGER PRIMARY KEY,
+            SIGLA_UF SIGLA_UF_T,
+            NOME_UF NOME_UF_T,
             NOME_MUNICIPIO VARCHAR(100),
-            PRIMARY KEY (SIGLA_UF, NOME_MUNICIPIO)
+            UNIQUE (SIGLA_UF, NOME_MUNICIPIO)
         );
     ''')
 
     # Criação da tabela Escola
     con.execute('''
-        CREATE TABLE Escola (
+        CREATE TABLE IF NOT EXISTS Escola (
             NOME_ESCOLA VARCHAR(200),
             CODIGO_ESCOLA VARCHAR(20),
             REDE_ESCOLA VARCHAR(20),
@@ -91,16 +175,16 @@ def criar_tabelas(con):
             SAEB_NOTA_MAT DOUBLE,
             SAEB_NOTA_PORT DOUBLE,
             SAEB_NOTA_PADRAO DOUBLE,
-            SIGLA_UF VARCHAR(2),
-            NOME_MUNICIPIO VARCHAR(100),
+            SIGLA_UF SIGLA_UF_T,
+            ID_MUNICIPIO INTEGER,
             PRIMARY KEY (CODIGO_ESCOLA, ANO_ESCOLA),
-            FOREIGN KEY (SIGLA_UF, NOME_MUNICIPIO) REFERENCES Municipio(SIGLA_UF, NOME_MUNICIPIO)
+            FOREIGN KEY (ID_MUNICIPIO) REFERENCES Municipio(ID_MUNICIPIO)
         );
     ''')
     
     # Criação da tabela Curso
     con.execute('''
-        CREATE TABLE Curso (
+        CREATE TABLE IF NOT EXISTS Curso (
             NOME_IES VARCHAR(200),
             SIGLA_IES VARCHAR(20),
             CODIGO_IES VARCHAR(20),
@@ -114,18 +198,141 @@ def criar_tabelas(con):
             NOTA_ENADE_CONTINUA DOUBLE,
             NOTA_ENADE_FAIXA INTEGER,
             ANO_ENADE INTEGER,
-            SIGLA_UF VARCHAR(2),
-            NOME_MUNICIPIO VARCHAR(100),
+            SIGLA_UF SIGLA_UF_T,
+            ID_MUNICIPIO INTEGER,
             PRIMARY KEY (CODIGO_IES, NOME_CURSO, ANO_ENADE),
-            FOREIGN KEY (SIGLA_UF, NOME_MUNICIPIO) REFERENCES Municipio(SIGLA_UF, NOME_MUNICIPIO)
+            FOREIGN KEY (ID_MUNICIPIO) REFERENCES Municipio(ID_MUNICIPIO)
+        );
+    ''')
+
+    # Criação da tabela ManifestoCarga (um registro por arquivo de origem carregado)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS ManifestoCarga (
+            ARQUIVO VARCHAR PRIMARY KEY,
+            TIPO VARCHAR(10),
+            HASH VARCHAR(64),
+            TAMANHO BIGINT,
+            MTIME DOUBLE,
+            ANOS INTEGER[],
+            CARREGADO_EM TIMESTAMP
+        );
+    ''')
+
+    # Criação da tabela Rejeitados (linhas de origem recusadas, com o motivo e o registro original)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS Rejeitados (
+            ARQUIVO VARCHAR,
+            LINHA BIGINT,
+            TABELA VARCHAR(10),
+            MOTIVO VARCHAR,
+            REGISTRO VARCHAR,
+            CARREGADO_EM TIMESTAMP DEFAULT current_timestamp
+        );
+    ''')
+
+    # --- Agregados do IDEB (notas não nulas) ---
+    # Por UF e ano: média, mínimo e máximo (consultas 1 e 3)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS AgregadoUfAno (
+            SIGLA_UF SIGLA_UF_T,
+            ANO_ESCOLA INTEGER,
+            QTD_IDEB BIGINT,
+            SOMA_IDEB DOUBLE,
+            MIN_IDEB DOUBLE,
+            MAX_IDEB DOUBLE,
+            PRIMARY KEY (SIGLA_UF, ANO_ESCOLA)
+        );
+    ''')
+    # Histograma das notas por UF e ano, para a mediana exata (consulta 1)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS HistogramaIdeb (
+            SIGLA_UF SIGLA_UF_T,
+            ANO_ESCOLA INTEGER,
+            IDEB_NOTA DOUBLE,
+            QTD BIGINT,
+            PRIMARY KEY (SIGLA_UF, ANO_ESCOLA, IDEB_NOTA)
+        );
+    ''')
+    # Por escola, com os anos avaliados (consultas 1 e 5)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS AgregadoEscola (
+            CODIGO_ESCOLA VARCHAR(20),
+            NOME_ESCOLA VARCHAR(200),
+            SIGLA_UF SIGLA_UF_T,
+            ID_MUNICIPIO INTEGER,
+            REDE_ESCOLA VARCHAR(20),
+            ANOS INTEGER[],
+            QTD_IDEB BIGINT,
+            SOMA_IDEB DOUBLE,
+            QTD_SAEB_MAT BIGINT,
+            SOMA_SAEB_MAT DOUBLE,
+            QTD_SAEB_PORT BIGINT,
+            SOMA_SAEB_PORT DOUBLE
+        );
+    ''')
+    # Amostra estratificada por UF das escolas de AgregadoEscola, com a fração da UF (modo aproximado)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS AmostraEscola (
+            CODIGO_ESCOLA VARCHAR(20),
+            NOME_ESCOLA VARCHAR(200),
+            SIGLA_UF SIGLA_UF_T,
+            ID_MUNICIPIO INTEGER,
+            REDE_ESCOLA VARCHAR(20),
+            ANOS INTEGER[],
+            QTD_IDEB BIGINT,
+            SOMA_IDEB DOUBLE,
+            QTD_SAEB_MAT BIGINT,
+            SOMA_SAEB_MAT DOUBLE,
+            QTD_SAEB_PORT BIGINT,
+            SOMA_SAEB_PORT DOUBLE,
+            FRACAO DOUBLE
+        );
+    ''')
+
+    # --- Agregados do ENADE (notas contínuas não nulas) ---
+    # Por curso e ano, com os conjuntos de UFs e IES para as contagens distintas (consulta 2)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS AgregadoCursoAno (
+            NOME_CURSO VARCHAR(200),
+            ANO_ENADE INTEGER,
+            QTD_ENADE BIGINT,
+            SOMA_ENADE DOUBLE,
+            SOMA_INSCRITOS BIGINT,
+            UFS SIGLA_UF_T[],
+            IES VARCHAR[],
+            PRIMARY KEY (NOME_CURSO, ANO_ENADE)
+        );
+    ''')
+    # Por UF, categoria de IES e ano (consulta 4)
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS AgregadoCategoriaIes (
+            SIGLA_UF SIGLA_UF_T,
+            CATEGORIA_IES VARCHAR(30),
+            ANO_ENADE INTEGER,
+            QTD_ENADE BIGINT,
+            SOMA_ENADE DOUBLE,
+            IES VARCHAR[],
+            PRIMARY KEY (SIGLA_UF, CATEGORIA_IES, ANO_ENADE)
         );
     ''')
 
-def str_to_float(value):
-    """Função auxiliar para converter uma série de strings com vírgula para float."""
-    if isinstance(value, pd.Series):
-        return pd.to_numeric(value.astype(str).str.replace(',', '.', regex=False), errors='coerce')
-    return pd.to_numeric(value, errors='coerce')
+def registrar_macros(con):
+    """Registra as macros SQL auxiliares usadas na transformação dos dados."""
+    # Converte texto com vírgula decimal para DOUBLE (NULL se não for numérico)
+    con.execute("CREATE OR REPLACE TEMP MACRO str_to_float(valor) AS TRY_CAST(REPLACE(valor, ',', '.') AS DOUBLE);")
+    # Nome completo da UF a partir da sigla (NULL se a sigla não existir)
+    ufs = ', '.join(f"{sql_texto(sigla)}: {sql_texto(nome)}" for sigla, nome in UF_NOMES.items())
+    con.execute(f"CREATE OR REPLACE TEMP MACRO nome_uf(sigla) AS MAP {{{ufs}}}[UPPER(TRIM(sigla))];")
+    # Categoria da IES a partir do nome (consulta 4)
+    con.execute('''
+        CREATE OR REPLACE TEMP MACRO categoria_ies(nome_ies) AS CASE
+            WHEN UPPER(nome_ies) LIKE '%FEDERAL%' OR UPPER(nome_ies) LIKE '%UNIVERSIDADE FEDERAL%'
+                 OR UPPER(nome_ies) LIKE '%INSTITUTO FEDERAL%' THEN 'Pública Federal'
+            WHEN UPPER(nome_ies) LIKE '%FUNDAÇÃO%' OR UPPER(nome_ies) LIKE '%FILANTRÓPICA%'
+                 OR UPPER(nome_ies) LIKE '%BENEFICENTE%' THEN 'Privada sem fins lucrativos'
+            ELSE 'Privada com fins lucrativos'
+        END;
+    ''')
 
 def find_column_name(columns, expected_name):
     """
@@ -140,218 +347,1483 @@ def find_column_name(columns, expected_name):
     # Retorna None se não encontrar para permitir tratamento de erro
     return None
 
-def carregar_dados(con):
+def sql_texto(valor):
+    """Escapa um valor como literal de texto SQL."""
+    return "'" + str(valor).replace("'", "''") + "'"
+
+def sql_coluna(nome):
+    """Escapa um nome de coluna como identificador SQL."""
+    return '"' + nome.replace('"', '""') + '"'
+
+def sql_valor(valor):
+    """Escreve um valor Python (None, bool, número, texto ou lista deles) como literal SQL."""
+    if valor is None:
+        return 'NULL'
+    if isinstance(valor, bool):
+        return 'TRUE' if valor else 'FALSE'
+    if isinstance(valor, int):
+        return str(valor)
+    if isinstance(valor, float):
+        return f"CAST('{valor!r}' AS DOUBLE)"
+    if isinstance(valor, (list, tuple)):
+        return f"[{', '.join(sql_valor(item) for item in valor)}]"
+    return sql_texto(valor)
+
+def sql_com_parametros(sql, parametros=None):
     """
-    Orquestra o carregamento, transformação e inserção dos dados nas tabelas.
+    Substitui no SQL os parâmetros nomeados ($nome), fora de literais e identificadores,
+    pelos seus valores como literais (sql_valor). Assim a consulta roda sem o binding de
+    parâmetros do cliente Python, que importa o pandas. Os $nome sem valor ficam como estão.
     """
+    if not parametros:
+        return sql
+    partes = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql)
+    substituir = lambda m: sql_valor(parametros[m[1]]) if m[1] in parametros else m[0]
+    return ''.join(parte if i % 2 else re.sub(r'\$([A-Za-z_]\w*)', substituir, parte) for i, parte in enumerate(partes))
 
-    # --- 1. Preparar Dados do IDEB/SAEB (para tabela Escola) ---
-    df_ideb_raw = pd.read_csv(
-        ARQUIVO_IDEB, 
-        sep=',', 
-        on_bad_lines='skip', 
-        dtype={'Código da Escola': str}, 
-        encoding='latin1',
-        low_memory=False
+def sql_read_csv(arquivos, tipos=None, rejeitos=False):
+    """
+    Monta a chamada read_csv do DuckDB para os arquivos de origem (latin1, vírgula decimal,
+    união por nome de coluna). Linhas malformadas (número de campos errado ou valor que não
+    converte para o tipo da coluna) ficam fora da leitura; com rejeitos, são registradas
+    pelo store_rejects do DuckDB (ver sql_linhas_malformadas), o que o DuckDB só aceita na
+    leitura de um único arquivo.
+    """
+    lista = ', '.join(sql_texto(a) for a in arquivos)
+    opcoes = "encoding='latin-1', header=true, decimal_separator=',', ignore_errors=true, filename=true"
+    if len(arquivos) > 1:
+        opcoes += ", union_by_name=true"
+    if rejeitos:
+        opcoes += ", store_rejects=true, rejects_table='rejeitos_csv', rejects_scan='rejeitos_csv_leituras'"
+    if tipos:
+        struct = ', '.join(f"{sql_texto(col)}: {sql_texto(tipo)}" for col, tipo in tipos.items())
+        opcoes += f", types={{{struct}}}"
+    else:
+        opcoes += ", all_varchar=true"
+    return f"read_csv([{lista}], {opcoes})"
+
+def sql_linhas_malformadas():
+    """
+    Consulta das linhas malformadas registradas pelas leituras com rejeitos da conexão
+    (ver sql_read_csv), uma por linha do arquivo, nas colunas de controle do staging:
+    LINHA é a linha no arquivo, MOTIVO o primeiro erro da linha e REGISTRO o texto original.
+    """
+    return '''
+        SELECT l.file_path AS ARQUIVO, CAST(e.line AS BIGINT) AS LINHA,
+               'linha malformada: ' || arg_min(e.error_message, e.byte_position) AS MOTIVO,
+               arg_min(e.csv_line, e.byte_position) AS REGISTRO
+        FROM rejeitos_csv e JOIN rejeitos_csv_leituras l USING (scan_id, file_id)
+        GROUP BY l.file_path, e.line
+    '''
+
+def descartar_rejeitos(con):
+    """Apaga os registros de linhas malformadas das leituras anteriores da conexão."""
+    con.execute("DROP TABLE IF EXISTS rejeitos_csv;")
+    con.execute("DROP TABLE IF EXISTS rejeitos_csv_leituras;")
+
+def sql_motivo_notas(colunas):
+    """Cláusulas WHEN do MOTIVO para as notas de `colunas` fora das faixas de LIMITES_NOTAS."""
+    clausulas = []
+    for coluna in colunas:
+        if coluna in LIMITES_NOTAS:
+            minimo, maximo = LIMITES_NOTAS[coluna]
+            clausulas.append(f"WHEN NOT {coluna} BETWEEN {minimo} AND {maximo} THEN '{coluna} fora da faixa [{minimo}, {maximo}]'")
+    return ' '.join(clausulas)
+
+def ler_cabecalho(con, arquivos):
+    """Retorna os nomes das colunas dos arquivos CSV sem carregar os dados."""
+    return [linha[0] for linha in con.execute(f"DESCRIBE SELECT * FROM {sql_read_csv(arquivos)}").fetchall()]
+
+def mapear_colunas(colunas, esperadas, origem):
+    """
+    Resolve, para cada nome esperado, o nome real da coluna no cabeçalho do arquivo.
+    Levanta ValueError se alguma coluna não for encontrada.
+    """
+    mapa = {chave: find_column_name(colunas, nome) for chave, nome in esperadas.items()}
+    if any(v is None for v in mapa.values()):
+        raise ValueError(f"Uma ou mais colunas não foram encontradas no arquivo {origem}. Verifique os nomes: {mapa}")
+    return mapa
+
+def colunas_notas_ideb(colunas):
+    """
+    Descobre no cabeçalho do arquivo IDEB/SAEB os anos disponíveis e as colunas de nota
+    de cada ano. Retorna {ano: {'IDEB_NOTA': coluna, 'SAEB_NOTA_MAT': coluna, ...}},
+    apenas para os anos que possuem as quatro colunas.
+    """
+    anos = sorted({int(m.group(1)) for col in colunas
+                   if (m := re.fullmatch(r'notaideb(\d{4})', re.sub(r'[\s_-]', '', col).lower()))})
+    notas_por_ano = {}
+    for ano in anos:
+        notas = {
+            'IDEB_NOTA': find_column_name(colunas, f'Nota_ideb_{ano}'),
+            'SAEB_NOTA_MAT': find_column_name(colunas, f'Nota_SAEB_{ano}_Mat'),
+            'SAEB_NOTA_PORT': find_column_name(colunas, f'Nota_SAEB_{ano}_Port'),
+            'SAEB_NOTA_PADRAO': find_column_name(colunas, f'Nota_padronizada_SAEB_{ano}')
+        }
+        if all(v is not None for v in notas.values()):
+            notas_por_ano[ano] = notas
+    return notas_por_ano
+
+def colunas_ideb(con, arquivo):
+    """
+    Resolve as colunas do arquivo IDEB/SAEB: retorna (colunas de identificação, como
+    identificadores SQL, e notas por ano, ver colunas_notas_ideb).
+    """
+    colunas = ler_cabecalho(con, [arquivo])
+    ideb_cols = mapear_colunas(colunas, {
+        'codigo': 'Código da Escola',
+        'nome': 'Nome da Escola',
+        'rede': 'Rede',
+        'uf': 'Sigla da UF',
+        'municipio': 'Nome do Município'
+    }, 'IDEB')
+    ideb_cols = {chave: sql_coluna(nome) for chave, nome in ideb_cols.items()}
+
+    notas_por_ano = colunas_notas_ideb(colunas)
+    if not notas_por_ano:
+        raise ValueError("Nenhum dado válido do IDEB/SAEB foi encontrado após a transformação. Verifique o arquivo CSV.")
+    return ideb_cols, notas_por_ano
+
+def sql_leitura_ideb(con, arquivo=ARQUIVO_IDEB, numerar=True):
+    """
+    Monta a leitura do arquivo IDEB/SAEB no formato largo (uma linha por escola), com as
+    colunas de identificação renomeadas, as de nota com o nome original e ARQUIVO. Com
+    numerar, acrescenta LINHA, a posição na leitura; o ROW_NUMBER sobre a leitura inteira
+    é bloqueante, e a carga em streaming numera as linhas lote a lote (ver
+    preparar_escolas_em_lotes).
+    """
+    ideb_cols, notas_por_ano = colunas_ideb(con, arquivo)
+    nomes_notas = list(next(iter(notas_por_ano.values())))
+    return f'''
+        SELECT
+            {ideb_cols['nome']} AS NOME_ESCOLA,
+            {ideb_cols['codigo']} AS CODIGO_ESCOLA,
+            {ideb_cols['rede']} AS REDE_ESCOLA,
+            {ideb_cols['uf']} AS SIGLA_UF,
+            {ideb_cols['municipio']} AS NOME_MUNICIPIO,
+            {', '.join(sql_coluna(notas[n]) for notas in notas_por_ano.values() for n in nomes_notas)},
+            filename AS ARQUIVO{', ROW_NUMBER() OVER () AS LINHA' if numerar else ''}
+        FROM {sql_read_csv([arquivo], rejeitos=True)}
+    '''
+
+def sql_escolas(con, arquivo=ARQUIVO_IDEB, lote=None):
+    """
+    Monta a consulta que lê o arquivo IDEB/SAEB (formato largo, uma linha por escola)
+    e devolve uma linha por (escola, ano), com as colunas de Escola e as COLUNAS_CONTROLE
+    (LINHA é a posição na leitura). A conversão de largo para longo é feita com um único
+    UNPIVOT sobre a leitura do CSV ou, se informado, sobre `lote` (tabela ou variável
+    Arrow com as linhas de sql_leitura_ideb já numeradas). Nenhuma linha é descartada:
+    as que não passam na validação (código, notas, UF, faixas de LIMITES_NOTAS) saem
+    com o MOTIVO preenchido.
+    """
+    _, notas_por_ano = colunas_ideb(con, arquivo)
+    nomes_notas = list(next(iter(notas_por_ano.values())))
+    grupos = ', '.join(
+        f"({', '.join(sql_coluna(notas[n]) for n in nomes_notas)}) AS {sql_coluna(str(ano))}"
+        for ano, notas in notas_por_ano.items()
     )
-    
-    df_ideb_raw = df_ideb_raw.iloc[:-14]
-    df_ideb_raw.columns = df_ideb_raw.columns.str.strip()
-
-    anos_ideb = [2017, 2019, 2021, 2023]
-    lista_df_anos = []
-
-    base_cols_map = {
-        'CODIGO_ESCOLA': find_column_name(df_ideb_raw.columns, 'Código da Escola'),
-        'NOME_ESCOLA': find_column_name(df_ideb_raw.columns, 'Nome da Escola'),
-        'REDE_ESCOLA': find_column_name(df_ideb_raw.columns, 'Rede'),
-        'SIGLA_UF': find_column_name(df_ideb_raw.columns, 'Sigla da UF'),
-        'NOME_MUNICIPIO': find_column_name(df_ideb_raw.columns, 'Nome do Município')
+    origem = lote or f'({sql_leitura_ideb(con, arquivo)})'
+
+    # O rodapé do arquivo (notas e fonte) tem número de campos diferente do cabeçalho e fica
+    # entre as linhas malformadas da leitura; o que restar é recusado pelo código não numérico.
+    # MOTIVO traz a primeira verificação em que a linha falhou (NULL se passou em todas).
+    return f'''
+        SELECT *, CASE
+                WHEN TRY_CAST(CODIGO_ESCOLA AS BIGINT) IS NULL THEN 'código da escola não numérico'
+                WHEN COALESCE({', '.join(nomes_notas)}) IS NULL THEN 'sem notas no ano'
+                WHEN nome_uf(SIGLA_UF) IS NULL THEN 'UF ausente ou desconhecida'
+                {sql_motivo_notas(nomes_notas)}
+            END AS MOTIVO,
+            CAST(NULL AS VARCHAR) AS REGISTRO
+        FROM (
+            SELECT
+                NOME_ESCOLA,
+                CODIGO_ESCOLA,
+                REDE_ESCOLA,
+                CAST(ANO_ESCOLA AS INTEGER) AS ANO_ESCOLA,
+                {', '.join(f'str_to_float({n}) AS {n}' for n in nomes_notas)},
+                SIGLA_UF,
+                NOME_MUNICIPIO,
+                ARQUIVO,
+                LINHA
+            FROM (
+                UNPIVOT {origem}
+                ON {grupos}
+                INTO NAME ANO_ESCOLA VALUE {', '.join(nomes_notas)}
+            )
+        )
+    '''
+
+def origem_escolas(con, arquivo, cache=None):
+    """
+    Retorna a consulta de origem das linhas de Escola: a leitura do CSV ou, se `cache`
+    (caminho do Parquet de staging) for informado, a leitura do cache, que é gravado
+    antes caso ainda não exista (com as linhas malformadas, ver gravar_cache_origem).
+    """
+    if cache is None:
+        return sql_escolas(con, arquivo)
+    if not os.path.exists(cache):
+        gravar_cache_origem(con, sql_escolas(con, arquivo), cache)
+    return f"SELECT * FROM read_parquet({sql_texto(cache)})"
+
+def anexar_staging(con, arquivo=None):
+    """
+    Anexa à conexão, se ainda não estiver anexado, o banco BANCO_STAGING, em que as
+    tabelas intermediárias da carga são gravadas comprimidas (ver compactar_staging): em
+    memória ou, com `arquivo`, em disco, onde as páginas saem da memória conforme o
+    memory_limit (carga em streaming, ver arquivo_staging).
+    """
+    if arquivo:
+        con.execute(f"ATTACH IF NOT EXISTS {sql_texto(arquivo)} AS {BANCO_STAGING};")
+    else:
+        con.execute(f"ATTACH IF NOT EXISTS ':memory:' AS {BANCO_STAGING} (COMPRESS);")
+
+def arquivo_staging(banco):
+    """
+    Caminho do banco de staging em disco da carga em streaming do banco `banco` (arquivo):
+    ao lado dele, no mesmo disco, e não em um /tmp que pode estar em memória.
+    """
+    return f'{banco}.etl'
+
+def remover_banco(arquivo):
+    """Remove o arquivo de um banco DuckDB e o seu WAL, se existirem."""
+    for caminho in (arquivo, f'{arquivo}.wal'):
+        if os.path.exists(caminho):
+            os.remove(caminho)
+
+def compactar_staging(con):
+    """
+    Comprime as tabelas de BANCO_STAGING: no banco em memória, a compressão (dicionário,
+    FSST, bit-packing, ALP) é aplicada no checkpoint, e sem ela cada texto ocupa ao menos
+    16 bytes e cada nota 8 bytes por linha. A compressão é sem perdas.
+    """
+    con.execute(f"CHECKPOINT {BANCO_STAGING};")
+
+def ler_origem(con, consulta, tabela, acrescentar=False):
+    """
+    Cria `tabela` (ou, com acrescentar, acrescenta a ela) com as linhas de `consulta` (uma
+    leitura de CSV com rejeitos) e as linhas malformadas dessa leitura, com o MOTIVO e o
+    texto original (ver sql_linhas_malformadas).
+    """
+    descartar_rejeitos(con)
+    if acrescentar:
+        con.execute(f"INSERT INTO {tabela} BY NAME {consulta};")
+    else:
+        con.execute(f"CREATE OR REPLACE TABLE {tabela} AS {consulta};")
+    con.execute(f"INSERT INTO {tabela} BY NAME {sql_linhas_malformadas()};")
+    descartar_rejeitos(con)
+
+def marcar_duplicadas(con, tabela, chave, ordem, parametros=None):
+    """
+    Preenche o MOTIVO das linhas válidas de `tabela` que repetem a `chave` de uma linha
+    válida anterior (na `ordem` informada), em um único UPDATE sobre a tabela.
+    """
+    con.execute(f'''
+        UPDATE {tabela} SET MOTIVO = 'chave duplicada ({chave})'
+        WHERE rowid IN (
+            SELECT rowid FROM {tabela}
+            WHERE MOTIVO IS NULL
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {chave} ORDER BY {ordem}) > 1
+        );
+    ''', parametros)
+
+def preparar_escolas(con, arquivo=ARQUIVO_IDEB, cache=None):
+    """
+    Cria a tabela stg_escola, em BANCO_STAGING, com as linhas do arquivo IDEB/SAEB e o
+    MOTIVO das que não passaram na validação, inclusive as repetições de (escola, ano)
+    depois da primeira ocorrência (na ordem do arquivo).
+    """
+    anexar_staging(con)
+    tabela = f'{BANCO_STAGING}.stg_escola'
+    if cache is None:
+        ler_origem(con, sql_escolas(con, arquivo), tabela)
+    else:
+        con.execute(f"CREATE OR REPLACE TABLE {tabela} AS {origem_escolas(con, arquivo, cache)};")
+    marcar_duplicadas(con, tabela, 'CODIGO_ESCOLA, ANO_ESCOLA', 'LINHA')
+    compactar_staging(con)
+
+def sql_municipios_novos(origem, com_codigo=False):
+    """
+    Comandos que inserem em Municipio os municípios das linhas válidas (sem MOTIVO) da
+    tabela, view ou subconsulta `origem` (colunas SIGLA_UF, NOME_MUNICIPIO e, se
+    com_codigo, CODIGO_MUNICIPIO) que ainda não estão cadastrados. Municípios com código
+    IBGE usam-no como ID_MUNICIPIO; os demais recebem um ID da sequência seq_municipio.
+    As linhas com UF desconhecida já chegam com MOTIVO (ver sql_escolas e sql_cursos).
+    """
+    comandos = []
+    if com_codigo:
+        # Um nome por código; um código já cadastrado com o mesmo nome não é repetido
+        comandos.append(f'''
+            INSERT INTO Municipio BY NAME
+            SELECT CODIGO_MUNICIPIO AS ID_MUNICIPIO, m.SIGLA_UF, nome_uf(m.SIGLA_UF) AS NOME_UF, m.NOME_MUNICIPIO
+            FROM (
+                SELECT CODIGO_MUNICIPIO, UPPER(TRIM(SIGLA_UF)) AS SIGLA_UF, NOME_MUNICIPIO
+                FROM {origem}
+                WHERE MOTIVO IS NULL AND CODIGO_MUNICIPIO IS NOT NULL AND SIGLA_UF IS NOT NULL AND NOME_MUNICIPIO IS NOT NULL
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY CODIGO_MUNICIPIO ORDER BY NOME_MUNICIPIO) = 1
+            ) m
+            ANTI JOIN Municipio c ON c.ID_MUNICIPIO = m.CODIGO_MUNICIPIO
+            ANTI JOIN Municipio n ON n.SIGLA_UF = m.SIGLA_UF AND n.NOME_MUNICIPIO = m.NOME_MUNICIPIO
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY m.SIGLA_UF, m.NOME_MUNICIPIO ORDER BY CODIGO_MUNICIPIO) = 1;
+        ''')
+
+    comandos.append(f'''
+        INSERT INTO Municipio BY NAME
+        SELECT nextval('seq_municipio') AS ID_MUNICIPIO, m.SIGLA_UF, nome_uf(m.SIGLA_UF) AS NOME_UF, m.NOME_MUNICIPIO
+        FROM (
+            SELECT DISTINCT UPPER(TRIM(SIGLA_UF)) AS SIGLA_UF, NOME_MUNICIPIO
+            FROM {origem}
+            WHERE MOTIVO IS NULL AND SIGLA_UF IS NOT NULL AND NOME_MUNICIPIO IS NOT NULL
+              {'AND CODIGO_MUNICIPIO IS NULL' if com_codigo else ''}
+        ) m
+        ANTI JOIN Municipio n ON n.SIGLA_UF = m.SIGLA_UF AND n.NOME_MUNICIPIO = m.NOME_MUNICIPIO;
+    ''')
+    return comandos
+
+def inserir_municipios(con, origem, com_codigo=False):
+    """Insere em Municipio os municípios novos de `origem` (ver sql_municipios_novos)."""
+    for comando in sql_municipios_novos(origem, com_codigo):
+        con.execute(comando)
+
+def juncao_municipio(com_codigo=False):
+    """
+    Junções que resolvem o município das linhas `o`: pelo código IBGE quando disponível
+    e, senão, pelo índice (SIGLA_UF, NOME_MUNICIPIO). Retorna (junções, expressão do
+    ID_MUNICIPIO, expressão da SIGLA_UF), NULL nas linhas sem município correspondente.
+    """
+    juncoes = "LEFT JOIN Municipio n ON n.SIGLA_UF = UPPER(TRIM(o.SIGLA_UF)) AND n.NOME_MUNICIPIO = o.NOME_MUNICIPIO"
+    if com_codigo:
+        juncoes = f"LEFT JOIN Municipio c ON c.ID_MUNICIPIO = o.CODIGO_MUNICIPIO {juncoes}"
+        return juncoes, 'COALESCE(c.ID_MUNICIPIO, n.ID_MUNICIPIO)', 'COALESCE(c.SIGLA_UF, n.SIGLA_UF)'
+    return juncoes, 'n.ID_MUNICIPIO', 'n.SIGLA_UF'
+
+def sql_com_municipio(origem, com_codigo=False):
+    """
+    Consulta que devolve as linhas válidas de `origem` com a SIGLA_UF do município e o
+    ID_MUNICIPIO no lugar de NOME_MUNICIPIO (e de CODIGO_MUNICIPIO), sem as
+    COLUNAS_CONTROLE. Linhas com MOTIVO ou sem município correspondente ficam de fora
+    (e entram em Rejeitados, ver sql_rejeitados).
+    """
+    excluir = 'SIGLA_UF, NOME_MUNICIPIO, CODIGO_MUNICIPIO' if com_codigo else 'SIGLA_UF, NOME_MUNICIPIO'
+    juncoes, id_municipio, sigla_uf = juncao_municipio(com_codigo)
+    return f'''
+        SELECT o.* EXCLUDE ({COLUNAS_CONTROLE}, {excluir}), {sigla_uf} AS SIGLA_UF, {id_municipio} AS ID_MUNICIPIO
+        FROM {origem} o {juncoes}
+        WHERE o.MOTIVO IS NULL AND {id_municipio} IS NOT NULL
+    '''
+
+def sql_rejeitados(origem, tabela, com_codigo=False):
+    """
+    Consulta, nas colunas de Rejeitados, das linhas de `origem` que não vão para `tabela`:
+    as que têm MOTIVO e as válidas sem município correspondente. REGISTRO é o texto
+    original das linhas malformadas ou, nas demais, a linha de staging em JSON.
+    """
+    juncoes, id_municipio, _ = juncao_municipio(com_codigo)
+    return f'''
+        SELECT o.ARQUIVO, o.LINHA, {sql_texto(tabela)} AS TABELA,
+               COALESCE(o.MOTIVO, 'município não encontrado') AS MOTIVO, o.REGISTRO
+        FROM (
+            SELECT * EXCLUDE (REGISTRO),
+                   COALESCE(REGISTRO, CAST(to_json(struct_pack(*COLUMNS(* EXCLUDE ({COLUNAS_CONTROLE})))) AS VARCHAR)) AS REGISTRO
+            FROM {origem}
+        ) o {juncoes}
+        WHERE o.MOTIVO IS NOT NULL OR {id_municipio} IS NULL
+    '''
+
+def preparar_escolas_em_lotes(con, arquivo=ARQUIVO_IDEB, tamanho_lote=TAMANHO_LOTE_IDEB, cache=None):
+    """
+    Cria a tabela stg_escola, como preparar_escolas, lendo o arquivo IDEB/SAEB em lotes de
+    no máximo `tamanho_lote` registros, sem materializar o arquivo inteiro em memória.
+    Cada lote é validado como um todo: as repetições de (escola, ano), dentro do lote ou
+    de um lote anterior (já em stg_escola), recebem MOTIVO, como em marcar_duplicadas.
+    Cada lote é gravado em uma transação própria: com BANCO_STAGING em disco (ver
+    arquivo_staging), a memória usada é a de um lote, qualquer que seja o tamanho do
+    arquivo. Com `cache`, os lotes vêm do cache de staging ou, se ele ainda não existir,
+    são gravados nele (ver gravar_cache_origem) enquanto o CSV é lido.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    anexar_staging(con)
+    tabela = f'{BANCO_STAGING}.stg_escola'
+    con.execute(f"CREATE OR REPLACE TABLE {tabela} AS SELECT * FROM ({sql_escolas(con, arquivo)}) LIMIT 0;")
+
+    # A leitura usa uma conexão própria: o resultado em streaming seria invalidado
+    # pelas inserções feitas em `con`. Os lotes são lidos no lugar, pelo nome da variável
+    # Python (replacement scan), sem cópia em tabelas temporárias.
+    leitor = con.cursor()
+    registrar_macros(leitor)
+    ler_csv = cache is None or not os.path.exists(cache)
+    if ler_csv:
+        # O CSV é lido no formato largo, sem o ROW_NUMBER bloqueante: LINHA é numerada aqui,
+        # na ordem da leitura, e cada linha lida vira uma linha por ano no lote.
+        anos = len(colunas_ideb(leitor, arquivo)[1])
+        lotes = leitor.execute(sql_leitura_ideb(leitor, arquivo, numerar=False)).to_arrow_reader(max(tamanho_lote // anos, 1))
+        consulta = sql_escolas(con, arquivo, lote='lote_csv')
+        temporario = f'{cache}.{os.getpid()}.tmp' if cache else None
+        gravador = None
+    else:
+        lotes = leitor.execute(f"SELECT * FROM read_parquet({sql_texto(cache)})").to_arrow_reader(tamanho_lote)
+    linhas_lidas = 0
+    for lote in lotes:
+        origem = 'lote'
+        if ler_csv:
+            lote_csv = lote.append_column('LINHA', pa.array(range(linhas_lidas + 1, linhas_lidas + 1 + lote.num_rows), pa.int64()))
+            linhas_lidas += lote.num_rows
+            origem = f'({consulta})'
+            if temporario:
+                # O cache guarda o lote antes da marcação das chaves repetidas, como em preparar_escolas
+                partes = con.execute(consulta).to_arrow_reader()
+                if gravador is None:
+                    os.makedirs(os.path.dirname(temporario), exist_ok=True)
+                    gravador = pq.ParquetWriter(temporario, partes.schema, compression='zstd')
+                for parte in partes:
+                    gravador.write_batch(parte)
+        # A junção com os lotes anteriores usa só a chave das linhas válidas (hash join) e
+        # as linhas já recusadas ficam com o próprio MOTIVO no CASE.
+        con.execute(f'''
+            INSERT INTO {tabela} BY NAME
+            SELECT l.* REPLACE (CASE
+                WHEN l.MOTIVO IS NOT NULL THEN l.MOTIVO
+                WHEN e.CODIGO_ESCOLA IS NOT NULL OR ROW_NUMBER() OVER (
+                    PARTITION BY l.MOTIVO IS NULL, l.CODIGO_ESCOLA, l.ANO_ESCOLA ORDER BY l.LINHA) > 1
+                THEN 'chave duplicada (CODIGO_ESCOLA, ANO_ESCOLA)' END AS MOTIVO)
+            FROM {origem} l
+            LEFT JOIN {tabela} e ON e.MOTIVO IS NULL AND e.CODIGO_ESCOLA = l.CODIGO_ESCOLA AND e.ANO_ESCOLA = l.ANO_ESCOLA
+            ORDER BY l.LINHA;
+        ''')
+    # Lendo do CSV, as linhas malformadas ficam registradas na conexão de leitura e só são
+    # conhecidas ao fim dela; no cache, entram com as colunas de dados nulas.
+    if ler_csv:
+        malformadas = leitor.execute(sql_linhas_malformadas()).to_arrow_table()
+        con.execute(f"INSERT INTO {tabela} BY NAME SELECT * FROM malformadas;")
+        if gravador is not None:
+            gravador.write_table(pa.concat_tables([gravador.schema.empty_table(), malformadas],
+                                                  promote_options='default').cast(gravador.schema))
+            gravador.close()
+            os.replace(temporario, cache)
+    leitor.close()
+    compactar_staging(con)
+
+def inserir_escolas_em_lotes(con, origem, tamanho_lote=TAMANHO_LOTE_IDEB):
+    """
+    Insere em Escola as linhas válidas da tabela de staging `origem` (ver
+    sql_com_municipio) em lotes de `tamanho_lote` linhas, na ordem em que foram gravadas
+    (rowid), cada lote ordenado por ORDEM_ESCOLA e confirmado em uma transação própria:
+    a memória presa pela transação (as linhas e o índice da chave ainda não confirmados)
+    é a de um lote. Deve ser chamada fora de uma transação. Retorna as linhas inseridas.
+    """
+    fim = con.execute(f"SELECT COALESCE(MAX(rowid) + 1, 0) FROM {origem}").fetchone()[0]
+    linhas = 0
+    for inicio in range(0, fim, tamanho_lote):
+        lote = f'(SELECT * FROM {origem} WHERE rowid >= {inicio} AND rowid < {inicio + tamanho_lote})'
+        linhas += con.execute(
+            f"INSERT INTO Escola BY NAME SELECT * FROM ({sql_com_municipio(lote)}) ORDER BY {ORDEM_ESCOLA};"
+        ).fetchone()[0]
+    return linhas
+
+def sql_cursos(con, arquivo):
+    """
+    Monta a consulta que lê um arquivo ENADE e devolve as linhas com as colunas de Curso
+    e as COLUNAS_CONTROLE (ARQUIVO é o arquivo de origem e LINHA a posição na leitura).
+    Nenhuma linha é descartada: as que não passam na validação (conceito SC, campos
+    obrigatórios, UF, faixas de LIMITES_NOTAS) saem com o MOTIVO preenchido.
+    """
+    enade_cols = mapear_colunas(ler_cabecalho(con, [arquivo]), {
+        'faixa': 'Conceito Enade (Faixa)',
+        'uf': 'Sigla da UF',
+        'fg_bruta': 'Nota Bruta - FG',
+        'fg_pad': 'Nota Padronizada - FG',
+        'ce_bruta': 'Nota Bruta - CE',
+        'ce_pad': 'Nota Padronizada - CE',
+        'continua': 'Conceito Enade (Contínuo)',
+        'sigla_ies': 'Sigla da IES',
+        'nome_ies': 'Nome da IES',
+        'cod_ies': 'Código da IES',
+        'nome_curso': 'Área de Avaliação',
+        'inscritos': 'Nº de Concluintes Inscritos',
+        'concluintes': 'Nº de Concluintes Participantes',
+        'ano': 'Ano',
+        'municipio': 'Município do Curso',
+        'cod_municipio': 'Código do Município'
+    }, 'ENADE')
+
+    # Tipos explícitos: evita a inferência do sniffer e converte a vírgula decimal na leitura.
+    # Linhas de rodapé dos arquivos falham na conversão de tipos e são descartadas.
+    # LINHA preserva a ordem dos arquivos para manter a primeira ocorrência de cada curso.
+    tipos = {'faixa': 'VARCHAR', 'uf': 'VARCHAR', 'sigla_ies': 'VARCHAR', 'nome_ies': 'VARCHAR',
+             'cod_ies': 'VARCHAR', 'nome_curso': 'VARCHAR', 'municipio': 'VARCHAR',
+             'fg_bruta': 'DOUBLE', 'fg_pad': 'DOUBLE', 'ce_bruta': 'DOUBLE', 'ce_pad': 'DOUBLE',
+             'continua': 'DOUBLE', 'inscritos': 'INTEGER', 'concluintes': 'INTEGER', 'ano': 'INTEGER',
+             'cod_municipio': 'INTEGER'}
+    tipos_csv = {enade_cols[chave]: tipo for chave, tipo in tipos.items()}
+    nomes_originais = enade_cols
+    enade_cols = {chave: sql_coluna(nome) for chave, nome in enade_cols.items()}
+
+    # Campos obrigatórios e a coluna em que são verificados (a faixa, no texto original)
+    colunas_essenciais = {'fg_bruta': 'NOTA_BRUTA_FG', 'fg_pad': 'NOTA_PADRONIZADA_FG', 'ce_bruta': 'NOTA_BRUTA_CE',
+                          'ce_pad': 'NOTA_PADRONIZADA_CE', 'continua': 'NOTA_ENADE_CONTINUA', 'faixa': 'FAIXA',
+                          'sigla_ies': 'SIGLA_IES'}
+    ausentes = ' '.join(f"WHEN {coluna} IS NULL THEN {sql_texto(nomes_originais[chave] + ' ausente')}"
+                        for chave, coluna in colunas_essenciais.items())
+    notas = ['NOTA_BRUTA_CE', 'NOTA_PADRONIZADA_CE', 'NOTA_BRUTA_FG', 'NOTA_PADRONIZADA_FG', 'NOTA_ENADE_CONTINUA', 'NOTA_ENADE_FAIXA']
+    # MOTIVO traz a primeira verificação em que a linha falhou (NULL se passou em todas)
+    return f'''
+        SELECT * EXCLUDE (FAIXA), CASE
+                WHEN FAIXA = 'SC' THEN 'sem conceito (SC)'
+                {ausentes}
+                WHEN nome_uf(SIGLA_UF) IS NULL THEN 'UF ausente ou desconhecida'
+                {sql_motivo_notas(notas)}
+            END AS MOTIVO,
+            CAST(NULL AS VARCHAR) AS REGISTRO
+        FROM (
+            SELECT
+                {enade_cols['nome_ies']} AS NOME_IES,
+                {enade_cols['sigla_ies']} AS SIGLA_IES,
+                {enade_cols['cod_ies']} AS CODIGO_IES,
+                LEFT({enade_cols['nome_curso']}, 200) AS NOME_CURSO,
+                {enade_cols['inscritos']} AS TOTAL_INSCRITOS,
+                {enade_cols['concluintes']} AS TOTAL_CONCLUINTES,
+                {enade_cols['ce_bruta']} AS NOTA_BRUTA_CE,
+                {enade_cols['ce_pad']} AS NOTA_PADRONIZADA_CE,
+                {enade_cols['fg_bruta']} AS NOTA_BRUTA_FG,
+                {enade_cols['fg_pad']} AS NOTA_PADRONIZADA_FG,
+                {enade_cols['continua']} AS NOTA_ENADE_CONTINUA,
+                TRY_CAST({enade_cols['faixa']} AS INTEGER) AS NOTA_ENADE_FAIXA,
+                {enade_cols['faixa']} AS FAIXA,
+                {enade_cols['ano']} AS ANO_ENADE,
+                {enade_cols['uf']} AS SIGLA_UF,
+                {enade_cols['municipio']} AS NOME_MUNICIPIO,
+                {enade_cols['cod_municipio']} AS CODIGO_MUNICIPIO,
+                filename AS ARQUIVO,
+                LINHA
+            FROM (SELECT *, ROW_NUMBER() OVER () AS LINHA FROM {sql_read_csv([arquivo], tipos_csv, rejeitos=True)})
+        )
+    '''
+
+def ler_arquivo_enade(arquivo, destino=None, threads=1, limite_memoria=None):
+    """
+    Lê e valida um único arquivo ENADE em uma conexão DuckDB em memória, com as linhas
+    malformadas. Devolve o resultado como tabela Arrow ou, se `destino` for informado,
+    grava-o nesse Parquet de staging e devolve o caminho. Executada nos processos de
+    preparar_cursos, com `limite_memoria` (memory_limit) a parte de cada processo.
+    """
+    con = duckdb.connect()
+    con.execute(f"SET threads = {int(threads)};")
+    if limite_memoria:
+        con.execute(f"SET memory_limit = {sql_texto(limite_memoria)};")
+    registrar_macros(con)
+    if destino is not None:
+        gravar_cache_origem(con, sql_cursos(con, arquivo), destino)
+        resultado = destino
+    else:
+        ler_origem(con, sql_cursos(con, arquivo), 'leitura')
+        resultado = con.table('leitura').to_arrow_table()
+    con.close()
+    return resultado
+
+def mapear_em_processos(funcao, processos, *argumentos, limite_memoria_mb=None):
+    """
+    Aplica `funcao` aos argumentos em um pool de processos, preservando a ordem. As
+    threads da máquina e, se informado, o `limite_memoria_mb` são divididos entre os
+    processos (argumentos threads e limite_memoria de `funcao`).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    from multiprocessing import get_context
+
+    # 'spawn' evita herdar, via fork, o estado interno da conexão DuckDB aberta
+    threads = max(1, (os.cpu_count() or 1) // processos)
+    simultaneos = min(processos, len(argumentos[0]))
+    limite = f'{limite_memoria_mb / simultaneos:.0f}MiB' if limite_memoria_mb else None
+    with ProcessPoolExecutor(max_workers=simultaneos, mp_context=get_context('spawn')) as pool:
+        return list(pool.map(partial(funcao, threads=threads, limite_memoria=limite), *argumentos))
+
+def preparar_cursos(con, arquivos=ARQUIVOS_ENADE, processos=None, cache=None):
+    """
+    Cria a tabela stg_curso, em BANCO_STAGING, com as linhas dos arquivos ENADE e o MOTIVO
+    das que não passaram na validação, inclusive as repetições de um curso depois da
+    primeira ocorrência (na ordem dos arquivos). A coluna ARQUIVO guarda o arquivo de
+    origem de cada linha.
+
+    Com processos > 1, cada arquivo é lido e limpo em um processo separado
+    (ler_arquivo_enade) e os lotes Arrow resultantes são unidos aqui.
+    Com `cache` ({arquivo: caminho do Parquet de staging}), os arquivos já presentes no
+    cache não são relidos; os demais são validados e gravados no cache antes da leitura.
+    """
+    paralelo = processos and processos > 1
+    if cache is not None:
+        faltantes = [a for a in arquivos if not os.path.exists(cache[a])]
+        if paralelo and len(faltantes) > 1:
+            mapear_em_processos(ler_arquivo_enade, processos, faltantes, [cache[a] for a in faltantes],
+                                limite_memoria_mb=limite_memoria_mb(con))
+        else:
+            for arquivo in faltantes:
+                gravar_cache_origem(con, sql_cursos(con, arquivo), cache[arquivo])
+        origem = f"read_parquet([{', '.join(sql_texto(cache[a]) for a in arquivos)}], union_by_name=true)"
+    elif paralelo and len(arquivos) > 1:
+        import pyarrow as pa
+        tabelas = mapear_em_processos(ler_arquivo_enade, processos, arquivos, limite_memoria_mb=limite_memoria_mb(con))
+        con.register('lotes_curso', pa.concat_tables(tabelas, promote_options='default'))
+        origem = 'lotes_curso'
+    else:
+        origem = None
+
+    anexar_staging(con)
+    tabela = f'{BANCO_STAGING}.stg_curso'
+    if origem is None:
+        # Uma leitura por arquivo: o registro das linhas malformadas não aceita vários arquivos
+        for posicao, arquivo in enumerate(arquivos):
+            ler_origem(con, sql_cursos(con, arquivo), tabela, acrescentar=posicao > 0)
+    else:
+        con.execute(f"CREATE OR REPLACE TABLE {tabela} AS SELECT * FROM {origem};")
+    if origem == 'lotes_curso':
+        con.unregister('lotes_curso')
+    marcar_duplicadas(con, tabela, 'CODIGO_IES, NOME_CURSO, ANO_ENADE', 'list_position(?, ARQUIVO), LINHA', [list(arquivos)])
+    compactar_staging(con)
+
+def assinatura_validacao(con, arquivo, tipo):
+    """
+    Hash das regras de validação de um arquivo de origem ('IDEB' ou 'ENADE'): as faixas
+    de LIMITES_NOTAS, o SQL gerado para ler e validar o arquivo (sql_escolas ou
+    sql_cursos) e as macros usadas por ele (registrar_macros, já registradas em `con`).
+    """
+    consulta = sql_escolas(con, arquivo) if tipo == 'IDEB' else sql_cursos(con, arquivo)
+    macros = con.execute('''
+        SELECT function_name, macro_definition FROM duckdb_functions()
+        WHERE function_type = 'macro' AND database_name = 'temp' ORDER BY ALL
+    ''').fetchall()
+    return hashlib.sha256(json.dumps([sorted(LIMITES_NOTAS.items()), consulta, macros]).encode()).hexdigest()
+
+def caminho_cache(arquivo, hash_, validacao):
+    """
+    Caminho do Parquet de staging para a versão `hash_` de um arquivo de origem, validada
+    pelas regras de assinatura `validacao` (ver assinatura_validacao): o cache guarda o
+    MOTIVO de cada linha, então mudar as regras também invalida o cache.
+    """
+    nome = os.path.splitext(os.path.basename(arquivo))[0]
+    chave = hashlib.sha256(f'{VERSAO_STAGING}:{hash_}:{validacao}'.encode()).hexdigest()
+    return os.path.join(PATH_CACHE_STAGING, f'{nome}-{chave[:16]}.parquet')
+
+def gravar_cache(con, consulta, destino):
+    """
+    Grava o resultado da consulta em Parquet comprimido (zstd). O arquivo é escrito
+    com outro nome e renomeado ao final, para que uma gravação interrompida nunca
+    deixe um cache incompleto.
+    """
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    temporario = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+    con.execute(f"COPY ({consulta}) TO {sql_texto(temporario)} (FORMAT parquet, COMPRESSION zstd);")
+    os.replace(temporario, destino)
+
+def gravar_cache_origem(con, consulta, destino):
+    """
+    Grava no cache de staging as linhas de `consulta` (uma leitura de CSV com rejeitos)
+    e as linhas malformadas dessa leitura, que só são conhecidas ao fim dela: havendo
+    alguma, o Parquet é regravado com elas acrescentadas, sem passar pela memória.
+    """
+    descartar_rejeitos(con)
+    parcial = f'{destino}.{os.getpid()}.parcial'
+    gravar_cache(con, consulta, parcial)
+    if con.execute(f"SELECT COUNT(*) FROM ({sql_linhas_malformadas()})").fetchone()[0]:
+        gravar_cache(con, f"SELECT * FROM read_parquet({sql_texto(parcial)}) UNION ALL BY NAME {sql_linhas_malformadas()}", destino)
+        os.remove(parcial)
+    else:
+        os.replace(parcial, destino)
+    descartar_rejeitos(con)
+
+def limpar_cache(arquivo, manter=None):
+    """Remove do cache de staging as versões de um arquivo de origem, exceto `manter`."""
+    nome = os.path.splitext(os.path.basename(arquivo))[0]
+    for caminho in glob.glob(os.path.join(PATH_CACHE_STAGING, f'{glob.escape(nome)}-*.parquet')):
+        versao = re.fullmatch(rf'{re.escape(nome)}-[0-9a-f]{{16}}\.parquet', os.path.basename(caminho))
+        if versao and caminho != manter:
+            os.remove(caminho)
+
+def ler_cache(arquivo, con=None):
+    """
+    Abre os dados já validados de um arquivo de origem a partir do cache de staging, como
+    uma relação DuckDB sobre o Parquet (leitura sob demanda, sem reprocessar o CSV). As
+    linhas recusadas pela validação vêm com o MOTIVO preenchido.
+    Levanta FileNotFoundError se o conteúdo atual do arquivo, com as regras de validação
+    atuais, ainda não estiver no cache.
+    """
+    con = con or duckdb.connect()
+    registrar_macros(con)
+    tipo = 'IDEB' if arquivo == ARQUIVO_IDEB else 'ENADE'
+    destino = caminho_cache(arquivo, hash_arquivo(arquivo), assinatura_validacao(con, arquivo, tipo))
+    if not os.path.exists(destino):
+        raise FileNotFoundError(f"Cache de staging não encontrado para {arquivo}; execute a carga primeiro.")
+    return con.read_parquet(destino)
+
+def hash_arquivo(caminho):
+    """Calcula o SHA-256 do conteúdo de um arquivo, lendo-o em blocos."""
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+def situacao_fontes(con, incremental):
+    """
+    Compara os arquivos de origem presentes em disco com o ManifestoCarga.
+    Retorna (fontes, removidas): fontes é uma lista de dicionários com ARQUIVO, TIPO,
+    HASH, TAMANHO, MTIME, ANOS (anos carregados anteriormente) e ALTERADO; removidas
+    lista os registros do manifesto cujos arquivos não existem mais.
+    O hash só é recalculado quando tamanho ou data de modificação mudaram.
+    """
+    manifesto = {
+        linha[0]: dict(zip(['ARQUIVO', 'TIPO', 'HASH', 'TAMANHO', 'MTIME', 'ANOS'], linha))
+        for linha in con.execute("SELECT ARQUIVO, TIPO, HASH, TAMANHO, MTIME, ANOS FROM ManifestoCarga").fetchall()
     }
-    if any(v is None for v in base_cols_map.values()):
-        raise ValueError(f"Uma ou mais colunas base não foram encontradas no arquivo IDEB. Verifique os nomes: {base_cols_map}")
+    fontes = []
+    for tipo, arquivos in [('IDEB', [ARQUIVO_IDEB]), ('ENADE', ARQUIVOS_ENADE)]:
+        for arquivo in arquivos:
+            stat = os.stat(arquivo)
+            anterior = manifesto.pop(arquivo, None)
+            fonte = {'ARQUIVO': arquivo, 'TIPO': tipo, 'TAMANHO': stat.st_size, 'MTIME': stat.st_mtime,
+                     'ANOS': anterior['ANOS'] if anterior else []}
+            if incremental and anterior and (anterior['TAMANHO'], anterior['MTIME']) == (stat.st_size, stat.st_mtime):
+                fonte['HASH'] = anterior['HASH']
+            else:
+                fonte['HASH'] = hash_arquivo(arquivo)
+            fonte['ALTERADO'] = not (incremental and anterior and anterior['HASH'] == fonte['HASH'])
+            fontes.append(fonte)
+    return fontes, list(manifesto.values())
+
+def atualizar_agregados(con, anos_ideb, anos_enade):
+    """
+    Recalcula as tabelas de agregados para os anos informados, a partir de Escola e
+    Curso já atualizadas. Os grupos por ano são apagados e refeitos; em AgregadoEscola,
+    que acumula vários anos, são refeitas as escolas com notas em algum desses anos,
+    antes ou depois da carga. AmostraEscola é refeita por inteiro a partir de
+    AgregadoEscola: em cada UF, a fração FRACAO_AMOSTRA das escolas, com no mínimo
+    AMOSTRA_MINIMA_UF (ou todas), as primeiras pela ordem do hash do código.
+    """
+    if anos_ideb:
+        anos = sorted(anos_ideb)
+        con.execute("DELETE FROM AgregadoUfAno WHERE list_contains(?, ANO_ESCOLA);", [anos])
+        con.execute('''
+            INSERT INTO AgregadoUfAno
+            SELECT SIGLA_UF, ANO_ESCOLA, COUNT(*), SUM(IDEB_NOTA), MIN(IDEB_NOTA), MAX(IDEB_NOTA)
+            FROM Escola
+            WHERE IDEB_NOTA IS NOT NULL AND list_contains(?, ANO_ESCOLA)
+            GROUP BY SIGLA_UF, ANO_ESCOLA;
+        ''', [anos])
+        con.execute("DELETE FROM HistogramaIdeb WHERE list_contains(?, ANO_ESCOLA);", [anos])
+        con.execute('''
+            INSERT INTO HistogramaIdeb
+            SELECT SIGLA_UF, ANO_ESCOLA, IDEB_NOTA, COUNT(*)
+            FROM Escola
+            WHERE IDEB_NOTA IS NOT NULL AND list_contains(?, ANO_ESCOLA)
+            GROUP BY SIGLA_UF, ANO_ESCOLA, IDEB_NOTA;
+        ''', [anos])
+        con.execute('''
+            CREATE OR REPLACE TEMP TABLE escolas_afetadas AS
+            SELECT CODIGO_ESCOLA FROM AgregadoEscola WHERE list_has_any(ANOS, ?)
+            UNION
+            SELECT CODIGO_ESCOLA FROM Escola WHERE IDEB_NOTA IS NOT NULL AND list_contains(?, ANO_ESCOLA);
+        ''', [anos, anos])
+        con.execute("DELETE FROM AgregadoEscola WHERE CODIGO_ESCOLA IN (SELECT CODIGO_ESCOLA FROM escolas_afetadas);")
+        con.execute('''
+            INSERT INTO AgregadoEscola
+            SELECT CODIGO_ESCOLA, NOME_ESCOLA, SIGLA_UF, ID_MUNICIPIO, REDE_ESCOLA,
+                   LIST(ANO_ESCOLA ORDER BY ANO_ESCOLA), COUNT(*), SUM(IDEB_NOTA),
+                   COUNT(SAEB_NOTA_MAT), SUM(SAEB_NOTA_MAT), COUNT(SAEB_NOTA_PORT), SUM(SAEB_NOTA_PORT)
+            FROM Escola
+            WHERE IDEB_NOTA IS NOT NULL AND CODIGO_ESCOLA IN (SELECT CODIGO_ESCOLA FROM escolas_afetadas)
+            GROUP BY CODIGO_ESCOLA, NOME_ESCOLA, SIGLA_UF, ID_MUNICIPIO, REDE_ESCOLA;
+        ''')
+        # O tamanho da amostra de cada UF depende do total de escolas dela, então a amostra
+        # não é mantida escola a escola como os agregados
+        con.execute("DELETE FROM AmostraEscola;")
+        con.execute('''
+            INSERT INTO AmostraEscola
+            SELECT * EXCLUDE (posicao, total, tamanho), tamanho / total
+            FROM (
+                SELECT *, LEAST(GREATEST(CEIL(? * total), ?), total) AS tamanho
+                FROM (
+                    SELECT a.*,
+                           ROW_NUMBER() OVER (PARTITION BY SIGLA_UF ORDER BY hash(CODIGO_ESCOLA), CODIGO_ESCOLA) AS posicao,
+                           COUNT(*) OVER (PARTITION BY SIGLA_UF) AS total
+                    FROM AgregadoEscola a
+                )
+            )
+            WHERE posicao <= tamanho;
+        ''', [FRACAO_AMOSTRA, AMOSTRA_MINIMA_UF])
+        con.execute("DROP TABLE escolas_afetadas;")
+
+    if anos_enade:
+        anos = sorted(anos_enade)
+        con.execute("DELETE FROM AgregadoCursoAno WHERE list_contains(?, ANO_ENADE);", [anos])
+        con.execute('''
+            INSERT INTO AgregadoCursoAno
+            SELECT NOME_CURSO, ANO_ENADE, COUNT(*), SUM(NOTA_ENADE_CONTINUA), SUM(TOTAL_INSCRITOS),
+                   LIST(DISTINCT SIGLA_UF) FILTER (WHERE SIGLA_UF IS NOT NULL),
+                   LIST(DISTINCT CODIGO_IES) FILTER (WHERE CODIGO_IES IS NOT NULL)
+            FROM Curso
+            WHERE NOTA_ENADE_CONTINUA IS NOT NULL AND list_contains(?, ANO_ENADE)
+            GROUP BY NOME_CURSO, ANO_ENADE;
+        ''', [anos])
+        con.execute("DELETE FROM AgregadoCategoriaIes WHERE list_contains(?, ANO_ENADE);", [anos])
+        con.execute('''
+            INSERT INTO AgregadoCategoriaIes
+            SELECT SIGLA_UF, categoria_ies(NOME_IES) AS CATEGORIA_IES, ANO_ENADE, COUNT(*), SUM(NOTA_ENADE_CONTINUA),
+                   LIST(DISTINCT CODIGO_IES) FILTER (WHERE CODIGO_IES IS NOT NULL)
+            FROM Curso
+            WHERE NOTA_ENADE_CONTINUA IS NOT NULL AND list_contains(?, ANO_ENADE)
+            GROUP BY SIGLA_UF, CATEGORIA_IES, ANO_ENADE;
+        ''', [anos])
+
+@contextmanager
+def medir_etapa(perfil, nome, con=None):
+    """
+    Mede uma etapa e acrescenta em `perfil` (lista) o registro com tempo de parede,
+    tempo de CPU do processo (cpu_segundos) e da thread que executa a etapa
+    (cpu_thread_segundos), pico de RSS do processo durante a etapa (ver
+    zerar_pico_memoria) e RSS ao fim da etapa. Em etapas simultâneas, como as consultas
+    do relatório, o CPU do processo e o pico incluem as demais; o CPU da thread não inclui
+    as threads internas do DuckDB. Com `con`, registra também a memória em uso pelo
+    DuckDB ao fim da etapa, por tipo (ver memoria_duckdb_mb). O registro é entregue ao
+    bloco, que pode acrescentar informações (ex.: 'linhas'). Com perfil=None não mede.
+    """
+    registro = {'etapa': nome}
+    if perfil is None:
+        yield registro
+        return
+    with _TRAVA_PICOS:
+        _PICOS['etapas'][id(registro)] = 0.0
+        zerar_pico_memoria()
+    inicio, inicio_cpu, inicio_thread = time.perf_counter(), time.process_time(), time.thread_time()
+    falhou = False
+    try:
+        yield registro
+    except BaseException:
+        falhou = True  # A transação abortada não aceitaria a consulta da memória do DuckDB
+        raise
+    finally:
+        registro['segundos'] = round(time.perf_counter() - inicio, 4)
+        registro['cpu_segundos'] = round(time.process_time() - inicio_cpu, 4)
+        registro['cpu_thread_segundos'] = round(time.thread_time() - inicio_thread, 4)
+        with _TRAVA_PICOS:
+            anterior = _PICOS['etapas'].pop(id(registro))
+            pico = memoria_status_mb('VmHWM')
+            pico = max(anterior, pico) if pico is not None else pico_memoria_mb()
+        atual = memoria_atual_mb()
+        registro['pico_rss_mb'] = round(pico, 1) if pico is not None else None
+        registro['rss_mb'] = round(atual, 1) if atual is not None else None
+        if con is not None and not falhou:
+            registro['memoria_duckdb_mb'] = memoria_duckdb_mb(con)
+        perfil.append(registro)
+
+def carregar_dados(con, incremental=False, tamanho_lote=None, processos=None, usar_cache=True, perfil=None, lago=False):
+    """
+    Orquestra o carregamento, transformação e inserção dos dados nas tabelas.
+    Toda a leitura e transformação é feita pelo DuckDB, sem passar por DataFrames.
+
+    No modo incremental apenas os arquivos alterados desde a última carga (segundo o
+    ManifestoCarga) são lidos: as partições ANO_ESCOLA/ANO_ENADE afetadas são apagadas
+    e recarregadas e os municípios novos são acrescentados a Municipio. As tabelas de
+    agregados são atualizadas na mesma transação, apenas para os anos afetados.
+
+    Com tamanho_lote, o arquivo IDEB/SAEB é lido em streaming, em lotes desse tamanho
+    (ver preparar_escolas_em_lotes), e o staging fica em disco (ver arquivo_staging), e
+    não em memória: a memória da carga deixa de crescer com o tamanho dos arquivos.
+    Com processos, os arquivos ENADE são lidos em paralelo, um por processo.
+    Com usar_cache, os dados validados de cada arquivo são lidos do (ou gravados no) cache
+    de staging em Parquet, indexado pelo hash do arquivo de origem e pelas regras de
+    validação (ver assinatura_validacao).
+
+    A validação não interrompe a carga: as linhas recusadas (malformadas, sem conceito,
+    com campos obrigatórios ausentes, UF desconhecida, notas fora de LIMITES_NOTAS, chave
+    repetida ou município não encontrado) vão para a tabela Rejeitados, com o motivo.
+    Com lago, ou se o banco já tiver o lago Parquet, as partições dos anos afetados são
+    exportadas para uma nova versão dele (ver atualizar_lago).
+    Com perfil (lista), cada etapa é medida e registrada nela (ver medir_etapa).
+    """
+    registrar_macros(con)
+    with medir_etapa(perfil, 'carga.situacao_fontes', con) as etapa:
+        fontes, removidas = situacao_fontes(con, incremental)
+        etapa['arquivos_alterados'] = [f['ARQUIVO'] for f in fontes if f['ALTERADO']]
+    cache = {
+        f['ARQUIVO']: caminho_cache(f['ARQUIVO'], f['HASH'], assinatura_validacao(con, f['ARQUIVO'], f['TIPO']))
+        for f in fontes
+    } if usar_cache else {}
+
+    # Anos afetados: os anos já carregados de arquivos alterados ou removidos
+    anos_afetados = {'IDEB': set(), 'ENADE': set()}
+    for fonte in removidas + [f for f in fontes if f['ALTERADO']]:
+        anos_afetados[fonte['TIPO']].update(fonte['ANOS'] or [])
+
+    preparadas = []
+    stg_escola, stg_curso = f'{BANCO_STAGING}.stg_escola', f'{BANCO_STAGING}.stg_curso'
+    if tamanho_lote:
+        banco = con.execute("SELECT path FROM duckdb_databases() WHERE database_name = current_database()").fetchone()[0]
+        staging = arquivo_staging(banco or DB_FILE)
+        remover_banco(staging)  # O de uma carga interrompida
+        anexar_staging(con, staging)
+
+    # --- 1. Preparar Dados do IDEB/SAEB (para tabela Escola) ---
+    ideb = next(f for f in fontes if f['TIPO'] == 'IDEB')
+    if ideb['ALTERADO']:
+        with medir_etapa(perfil, 'carga.preparar_escolas', con) as etapa:
+            if tamanho_lote:
+                preparar_escolas_em_lotes(con, ideb['ARQUIVO'], tamanho_lote, cache.get(ideb['ARQUIVO']))
+            else:
+                preparar_escolas(con, ideb['ARQUIVO'], cache.get(ideb['ARQUIVO']))
+            etapa['linhas'] = con.execute(f"SELECT COUNT(*) FROM {stg_escola}").fetchone()[0]
+        ideb['ANOS'] = [linha[0] for linha in con.execute(f"SELECT DISTINCT ANO_ESCOLA FROM {stg_escola} WHERE ANO_ESCOLA IS NOT NULL ORDER BY 1").fetchall()]
+        preparadas.append(stg_escola)
+    anos_afetados['IDEB'].update(ideb['ANOS'] if ideb['ALTERADO'] else [])
+
+    # --- 2. Preparar Dados do ENADE (para tabela Curso) ---
+    # Um ano pode vir de mais de um arquivo: os arquivos inalterados que contêm anos
+    # afetados são relidos junto, para que a partição seja reconstruída por inteiro.
+    enade = [f for f in fontes if f['TIPO'] == 'ENADE']
+    a_ler = [f for f in enade if f['ALTERADO']]
+    while a_ler:
+        with medir_etapa(perfil, 'carga.preparar_cursos', con) as etapa:
+            preparar_cursos(con, sorted(f['ARQUIVO'] for f in a_ler), processos, cache or None)
+            etapa['linhas'] = con.execute(f"SELECT COUNT(*) FROM {stg_curso}").fetchone()[0]
+        anos_por_arquivo = dict(con.execute(
+            f"SELECT ARQUIVO, LIST(DISTINCT ANO_ENADE ORDER BY ANO_ENADE) FILTER (WHERE ANO_ENADE IS NOT NULL) FROM {stg_curso} GROUP BY ARQUIVO"
+        ).fetchall())
+        for fonte in a_ler:
+            fonte['ANOS'] = anos_por_arquivo.get(fonte['ARQUIVO'], [])
+            anos_afetados['ENADE'].update(fonte['ANOS'])
+        extras = [f for f in enade if f not in a_ler and anos_afetados['ENADE'] & set(f['ANOS'] or [])]
+        if not extras:
+            preparadas.append(stg_curso)
+            break
+        a_ler += extras
+
+    con.execute("BEGIN TRANSACTION;")
+    try:
+        # --- 3. Criar e Popular Tabela Municipio ---
+        # Os municípios do ENADE (com código IBGE) entram antes dos do IDEB, que são
+        # resolvidos pelo nome.
+        with medir_etapa(perfil, 'carga.inserir_municipios', con) as etapa:
+            antes = con.execute("SELECT COUNT(*) FROM Municipio").fetchone()[0]
+            if stg_curso in preparadas:
+                inserir_municipios(con, stg_curso, com_codigo=True)
+            if stg_escola in preparadas:
+                inserir_municipios(con, stg_escola)
+            etapa['linhas'] = con.execute("SELECT COUNT(*) FROM Municipio").fetchone()[0] - antes
+
+        # --- 4. Registrar as linhas recusadas pela validação ---
+        # As rejeições anteriores dos arquivos relidos (ou removidos) são substituídas
+        with medir_etapa(perfil, 'carga.rejeitados', con) as etapa:
+            relidos = [f['ARQUIVO'] for f in removidas + a_ler] + ([ideb['ARQUIVO']] if ideb['ALTERADO'] else [])
+            if relidos:
+                con.execute("DELETE FROM Rejeitados WHERE list_contains(?::VARCHAR[], ARQUIVO);", [relidos])
+            etapa['linhas'] = 0
+            if stg_escola in preparadas:
+                etapa['linhas'] += con.execute(f"INSERT INTO Rejeitados BY NAME {sql_rejeitados(stg_escola, 'Escola')};").fetchone()[0]
+            if stg_curso in preparadas:
+                etapa['linhas'] += con.execute(
+                    f"INSERT INTO Rejeitados BY NAME {sql_rejeitados(stg_curso, 'Curso', com_codigo=True)};"
+                ).fetchone()[0]
+
+        # --- 5. Substituir as partições afetadas de Escola e Curso ---
+        with medir_etapa(perfil, 'carga.apagar_particoes', con) as etapa:
+            etapa['linhas'] = 0
+            if anos_afetados['IDEB']:
+                etapa['linhas'] += con.execute("DELETE FROM Escola WHERE list_contains(?, ANO_ESCOLA);",
+                                               [sorted(anos_afetados['IDEB'])]).fetchone()[0]
+            if anos_afetados['ENADE']:
+                etapa['linhas'] += con.execute("DELETE FROM Curso WHERE list_contains(?, ANO_ENADE);",
+                                               [sorted(anos_afetados['ENADE'])]).fetchone()[0]
+
+        if stg_escola in preparadas and not tamanho_lote:
+            with medir_etapa(perfil, 'carga.inserir_escolas', con) as etapa:
+                etapa['linhas'] = con.execute(
+                    f"INSERT INTO Escola BY NAME SELECT * FROM ({sql_com_municipio(stg_escola)}) ORDER BY {ORDEM_ESCOLA};"
+                ).fetchone()[0]
+        if stg_curso in preparadas:
+            with medir_etapa(perfil, 'carga.inserir_cursos', con) as etapa:
+                etapa['linhas'] = con.execute(
+                    f"INSERT INTO Curso BY NAME SELECT * FROM ({sql_com_municipio(stg_curso, com_codigo=True)}) ORDER BY {ORDEM_CURSO};"
+                ).fetchone()[0]
+        if stg_escola in preparadas and tamanho_lote:
+            # Em streaming, a transação é confirmada aqui e as escolas entram em lotes, cada
+            # um na sua transação (ver inserir_escolas_em_lotes); agregados e manifesto vão
+            # em outra. Uma falha a partir daqui deixa as partições do IDEB/SAEB incompletas,
+            # mas o manifesto ainda não foi atualizado e a próxima carga as refaz.
+            con.execute("COMMIT;")
+            try:
+                with medir_etapa(perfil, 'carga.inserir_escolas', con) as etapa:
+                    etapa['linhas'] = inserir_escolas_em_lotes(con, stg_escola, tamanho_lote)
+            finally:
+                con.execute("BEGIN TRANSACTION;")
+
+        # --- 6. Atualizar os agregados dos anos afetados ---
+        with medir_etapa(perfil, 'carga.atualizar_agregados', con):
+            atualizar_agregados(con, anos_afetados['IDEB'], anos_afetados['ENADE'])
+
+        # --- 7. Atualizar o manifesto ---
+        for fonte in removidas:
+            con.execute("DELETE FROM ManifestoCarga WHERE ARQUIVO = ?;", [fonte['ARQUIVO']])
+        for fonte in fontes:
+            recarregada = fonte['ALTERADO'] or fonte in a_ler
+            con.execute('''
+                INSERT OR REPLACE INTO ManifestoCarga
+                VALUES (?, ?, ?, ?, ?, ?, CASE WHEN ? THEN now() ELSE
+                    (SELECT CARREGADO_EM FROM ManifestoCarga WHERE ARQUIVO = ?) END);
+            ''', [fonte['ARQUIVO'], fonte['TIPO'], fonte['HASH'], fonte['TAMANHO'], fonte['MTIME'],
+                  fonte['ANOS'], recarregada, fonte['ARQUIVO']])
+    except Exception:
+        con.execute("ROLLBACK;")
+        raise
+    with medir_etapa(perfil, 'carga.commit', con):
+        con.execute("COMMIT;")
+
+    for tabela in preparadas:
+        con.execute(f"DROP TABLE {tabela};")
+    con.execute(f"DETACH DATABASE IF EXISTS {BANCO_STAGING};")
+    if tamanho_lote:
+        remover_banco(staging)
+
+    # --- 8. Atualizar o lago Parquet (opcional) ---
+    if lago or lago_ativo(con):
+        with medir_etapa(perfil, 'carga.lago', con):
+            if incremental:
+                atualizar_lago(con, anos_afetados['IDEB'], anos_afetados['ENADE'])
+            else:
+                atualizar_lago(con)
+
+    # Versões antigas do cache de staging deixam de ser usadas
+    if usar_cache:
+        for fonte in fontes:
+            limpar_cache(fonte['ARQUIVO'], manter=cache[fonte['ARQUIVO']])
+        for fonte in removidas:
+            limpar_cache(fonte['ARQUIVO'])
+
+def lago_ativo(con):
+    """Indica se o banco já expõe o lago Parquet (views LagoEscola e LagoCurso)."""
+    return con.execute("SELECT COUNT(*) FROM duckdb_views() WHERE view_name = 'LagoEscola'").fetchone()[0] > 0
+
+def diretorios_lago(con):
+    """
+    Diretórios do lago lidos pelas views LagoEscola e LagoCurso do banco, por view
+    (ex.: {'LagoEscola': '/.../lago/20240101-120000-000000/escola'}).
+    """
+    diretorios = {}
+    for view, sql in con.execute(
+            "SELECT view_name, sql FROM duckdb_views() WHERE view_name IN ('LagoEscola', 'LagoCurso')").fetchall():
+        padrao = re.search(r"read_parquet\('((?:[^']|'')*)'", sql)
+        if padrao:
+            # O padrão é <diretório>/*/*/*.parquet (ano=/uf=/arquivo)
+            diretorios[view] = padrao[1].replace("''", "'").rsplit(os.sep, 3)[0]
+    return diretorios
+
+def ligar_ou_copiar(origem, destino):
+    """Cria `destino` como hard link de `origem` (sem cópia) ou, se não for possível, como cópia."""
+    try:
+        os.link(origem, destino)
+    except OSError:
+        shutil.copy2(origem, destino)
+
+def atualizar_lago(con, anos_ideb=None, anos_enade=None, destino=PATH_LAGO):
+    """
+    Exporta Escola e Curso para uma nova versão do lago Parquet (um diretório de
+    `destino` nomeado pela data e hora), particionada no estilo hive (ano=/uf=), e
+    (re)cria as views LagoEscola e LagoCurso sobre ela. Consultas às views que filtram
+    ano ou UF leem apenas os arquivos dessas partições. Com os conjuntos de anos, só as
+    partições desses anos são exportadas; as demais vêm da versão lida até então pelas
+    views, por hard link. Com None, o lago inteiro.
+    As versões anteriores não mudam: o banco em uso, durante uma carga --sombra, e as
+    cópias em snapshots continuam lendo as suas (ver podar_lago). Retorna a nova versão.
+    """
+    anteriores = diretorios_lago(con)
+    versao = os.path.abspath(os.path.join(destino, f'{datetime.now():%Y%m%d-%H%M%S-%f}'))
+    for tabela, coluna_ano, view, anos in (('Escola', 'ANO_ESCOLA', 'LagoEscola', anos_ideb),
+                                           ('Curso', 'ANO_ENADE', 'LagoCurso', anos_enade)):
+        diretorio = os.path.join(versao, tabela.lower())
+        anterior = anteriores.get(view)
+        if anos is None or anterior is None or not os.path.isdir(anterior):
+            os.makedirs(diretorio)
+            filtro = ''
+        else:
+            recarregadas = {f'ano={int(ano)}' for ano in anos}
+            shutil.copytree(anterior, diretorio, copy_function=ligar_ou_copiar,
+                            ignore=lambda pasta, nomes: recarregadas & set(nomes) if pasta == anterior else set())
+            filtro = f"WHERE list_contains([{', '.join(str(int(ano)) for ano in anos)}]::INTEGER[], {coluna_ano})"
+        if not filtro or anos:
+            con.execute(f'''
+                COPY (
+                    SELECT * EXCLUDE ({coluna_ano}, SIGLA_UF), {coluna_ano} AS ano, SIGLA_UF AS uf
+                    FROM {tabela} {filtro}
+                    ORDER BY ano, uf, ID_MUNICIPIO
+                ) TO {sql_texto(diretorio)} (FORMAT parquet, COMPRESSION zstd, PARTITION_BY (ano, uf), OVERWRITE_OR_IGNORE);
+            ''')
+        con.execute(f'''
+            CREATE OR REPLACE VIEW {view} AS
+            SELECT * EXCLUDE (ano, uf), ano AS {coluna_ano}, uf AS SIGLA_UF
+            FROM read_parquet({sql_texto(os.path.join(diretorio, '*', '*', '*.parquet'))},
+                              hive_partitioning = true, hive_types = {{'ano': INTEGER, 'uf': VARCHAR}});
+        ''')
+    return versao
+
+def podar_lago(con=None, destino=PATH_LAGO, snapshots=PATH_SNAPSHOTS):
+    """
+    Remove de `destino` as versões do lago que nenhum banco lê mais: nem DB_FILE (ou o
+    banco já aberto em `con`) nem as cópias guardadas em `snapshots`. Se algum desses
+    bancos não puder ser aberto, nada é removido. Retorna as versões removidas.
+    """
+    if not os.path.isdir(destino):
+        return []
+    em_uso = set(diretorios_lago(con).values()) if con is not None else set()
+    bancos = [] if con is not None else [DB_FILE]
+    bancos += [caminho for caminho in glob.glob(os.path.join(snapshots, '*')) if not caminho.endswith('.wal')]
+    for banco in bancos:
+        if not os.path.exists(banco):
+            continue
+        try:
+            leitor = duckdb.connect(banco, read_only=True)
+        except duckdb.Error:
+            return []
+        try:
+            em_uso.update(diretorios_lago(leitor).values())
+        finally:
+            leitor.close()
+    removidas = []
+    for nome in sorted(os.listdir(destino)):
+        versao = os.path.abspath(os.path.join(destino, nome))
+        if os.path.isdir(versao) and not any(d == versao or d.startswith(versao + os.sep) for d in em_uso):
+            shutil.rmtree(versao)
+            removidas.append(versao)
+    return removidas
 
-    for ano in anos_ideb:
-        df_ano = df_ideb_raw[list(base_cols_map.values())].copy()
-        df_ano['ANO_ESCOLA'] = ano
-        
+def versao_dados(con):
+    """
+    Versão dos dados carregados, derivada do ManifestoCarga: muda a cada carga que
+    recarrega algum arquivo (CARREGADO_EM) e a cada arquivo incluído ou removido.
+    """
+    return con.execute('''
+        SELECT sha256(COALESCE(string_agg(ARQUIVO || ':' || HASH || ':' || CARREGADO_EM, ',' ORDER BY ARQUIVO), ''))
+        FROM ManifestoCarga
+    ''').fetchone()[0]
+
+def normalizar_sql(sql):
+    """Normaliza o texto SQL para a chave do cache, colapsando espaços fora de literais."""
+    partes = re.split(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""", sql)
+    return ''.join(parte if i % 2 else re.sub(r'\s+', ' ', parte) for i, parte in enumerate(partes)).strip(' ;')
+
+def podar_cache_consultas(limite=TAMANHO_CACHE_CONSULTAS, manter=None):
+    """
+    Remove os resultados usados há mais tempo até o cache de consultas caber em
+    `limite` bytes. O arquivo `manter` (o que acabou de ser gravado) nunca é removido.
+    """
+    entradas = []
+    for caminho in glob.glob(os.path.join(PATH_CACHE_CONSULTAS, '*.parquet')):
         try:
-            df_ano['IDEB_NOTA'] = str_to_float(df_ideb_raw[f'Nota_ideb_{ano}'])
-            df_ano['SAEB_NOTA_MAT'] = str_to_float(df_ideb_raw[f'Nota_SAEB_{ano}_Mat'])
-            df_ano['SAEB_NOTA_PORT'] = str_to_float(df_ideb_raw[f'Nota_SAEB_{ano}_Port'])
-            df_ano['SAEB_NOTA_PADRAO'] = str_to_float(df_ideb_raw[f'Nota_padronizada_SAEB_{ano}'])
-        except KeyError as e:
+            stat = os.stat(caminho)
+        except FileNotFoundError:
             continue
+        entradas.append((stat.st_mtime, stat.st_size, caminho))
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, caminho in sorted(entradas):
+        if total <= limite:
+            break
+        if caminho == manter:
+            continue
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
 
-        df_ano.dropna(subset=['IDEB_NOTA', 'SAEB_NOTA_MAT', 'SAEB_NOTA_PORT', 'SAEB_NOTA_PADRAO'], how='all', inplace=True)
-        
-        if not df_ano.empty:
-            lista_df_anos.append(df_ano)
+def arquivo_consulta(con, sql, parametros=None):
+    """
+    Retorna o arquivo Parquet com o resultado da consulta no cache de consultas,
+    executando-a apenas se ainda não estiver lá. O resultado é indexado pelo SQL
+    normalizado, pelos parâmetros e pela versão dos dados (versao_dados), e vale
+    enquanto os dados não forem recarregados. O último acesso fica no mtime do
+    arquivo (descarte LRU).
+    """
+    sql = sql_com_parametros(sql.strip().rstrip(';'), parametros)
+    chave = json.dumps([normalizar_sql(sql), versao_dados(con)])
+    destino = os.path.join(PATH_CACHE_CONSULTAS, hashlib.sha256(chave.encode()).hexdigest()[:32] + '.parquet')
+    if os.path.exists(destino):
+        try:
+            con.read_parquet(destino)
+            os.utime(destino)
+            return destino
+        except (duckdb.Error, OSError):
+            pass  # Entrada removida ou corrompida: a consulta é executada de novo
 
-    if not lista_df_anos:
-        raise ValueError("Nenhum dado válido do IDEB/SAEB foi encontrado após a transformação. Verifique o arquivo CSV.")
+    gravar_cache(con, sql, destino)
+    podar_cache_consultas(manter=destino)
+    return destino
 
-    df_escola_final = pd.concat(lista_df_anos, ignore_index=True)
-    df_escola_final.rename(columns={v: k for k, v in base_cols_map.items()}, inplace=True)
+def relacao_consulta(con, sql, parametros=None, usar_cache=True):
+    """
+    Retorna o resultado de uma consulta como relação DuckDB, sem convertê-lo para
+    pandas. Com usar_cache, a relação lê o Parquet do cache de consultas (ver
+    arquivo_consulta). Sem cache, é a própria consulta, executada em streaming a cada
+    leitura. Os parâmetros vão como literais no SQL (sql_com_parametros): o binding de
+    parâmetros do cliente Python importa o pandas e materializa o resultado inteiro.
+    """
+    if not usar_cache:
+        return con.sql(sql_com_parametros(sql.strip().rstrip(';'), parametros))
+    return con.read_parquet(arquivo_consulta(con, sql, parametros))
 
-    for col in ['IDEB_REND1', 'IDEB_REND2', 'IDEB_REND3', 'IDEB_REND4']:
-        df_escola_final[col] = np.nan
-    df_escola_final.dropna(subset=['CODIGO_ESCOLA', 'ANO_ESCOLA'], inplace=True)
-    df_escola_final = df_escola_final.drop_duplicates(subset=['CODIGO_ESCOLA', 'ANO_ESCOLA'])
-    
-    # --- 2. Preparar Dados do ENADE (para tabela Curso) ---
-    df_enade = pd.concat(
-        [pd.read_csv(
-            f, 
-            sep=',', 
-            on_bad_lines='skip', 
-            dtype={'Código da IES': str, 'Código do Curso': str}, 
-            encoding='latin1',
-            low_memory=False
-        ) for f in ARQUIVOS_ENADE],
-        ignore_index=True
-    )
-    df_enade.columns = df_enade.columns.str.strip()
-
-    enade_cols = {
-        'faixa': find_column_name(df_enade.columns, 'Conceito Enade (Faixa)'),
-        'uf': find_column_name(df_enade.columns, 'Sigla da UF'), 
-        'fg_bruta': find_column_name(df_enade.columns, 'Nota Bruta - FG'),
-        'fg_pad': find_column_name(df_enade.columns, 'Nota Padronizada - FG'),
-        'ce_bruta': find_column_name(df_enade.columns, 'Nota Bruta - CE'),
-        'ce_pad': find_column_name(df_enade.columns, 'Nota Padronizada - CE'),
-        'continua': find_column_name(df_enade.columns, 'Conceito Enade (Contínuo)'),
-        'sigla_ies': find_column_name(df_enade.columns, 'Sigla da IES'),
-        'nome_ies': find_column_name(df_enade.columns, 'Nome da IES'),
-        'cod_ies': find_column_name(df_enade.columns, 'Código da IES'),
-        'nome_curso': find_column_name(df_enade.columns, 'Área de Avaliação'), 
-        'inscritos': find_column_name(df_enade.columns, 'Nº de Concluintes Inscritos'),
-        'concluintes': find_column_name(df_enade.columns, 'Nº de Concluintes Participantes'),
-        'ano': find_column_name(df_enade.columns, 'Ano'),
-        'municipio': find_column_name(df_enade.columns, 'Município do Curso')
+def executar_consulta(con, sql, parametros=None, usar_cache=True):
+    """Executa uma consulta e retorna o resultado como DataFrame (ver relacao_consulta)."""
+    return relacao_consulta(con, sql, parametros, usar_cache).df()
+
+def memoria_status_mb(campo):
+    """Lê um campo de memória de /proc/self/status (ex.: VmHWM, VmRSS) em MB, ou None se indisponível."""
+    try:
+        with open('/proc/self/status') as f:
+            for linha in f:
+                if linha.startswith(f'{campo}:'):
+                    return int(linha.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+# Picos de RSS já zerados no VmHWM: o do processo e o parcial de cada etapa em medição
+# (ver zerar_pico_memoria e medir_etapa)
+_PICOS = {'processo': 0.0, 'etapas': {}}
+_TRAVA_PICOS = threading.Lock()
+
+def zerar_pico_memoria():
+    """
+    Zera o VmHWM do processo (escrevendo 5 em /proc/self/clear_refs), para que ele passe
+    a medir o pico a partir daqui. O pico até este ponto é guardado antes, no do processo
+    (ver pico_memoria_mb) e no de cada etapa em medição. Deve ser chamada com
+    _TRAVA_PICOS. Retorna False se o sistema não permitir; o VmHWM continua sendo o pico
+    desde o início do processo.
+    """
+    pico = memoria_status_mb('VmHWM')
+    if pico is None:
+        return False
+    _PICOS['processo'] = max(_PICOS['processo'], pico)
+    for chave, parcial in _PICOS['etapas'].items():
+        _PICOS['etapas'][chave] = max(parcial, pico)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def pico_memoria_mb():
+    """
+    Retorna o pico de memória residente (RSS) do processo em MB, ou None se indisponível.
+    No Linux é o VmHWM, que vale só para o programa em execução (o ru_maxrss, usado nos
+    demais sistemas, mantém no exec o pico do processo pai), sem perder os picos anteriores
+    às zeragens feitas por medir_etapa.
+    """
+    pico = memoria_status_mb('VmHWM')
+    if pico is not None:
+        return max(pico, _PICOS['processo'])
+    try:
+        import resource
+    except ImportError:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss é em bytes no macOS e em KB no Linux
+    return pico / (1 << 20) if sys.platform == 'darwin' else pico / 1024
+
+def memoria_atual_mb():
+    """Retorna a memória residente (RSS) atual do processo em MB, ou None se indisponível."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1 << 20)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def memoria_duckdb_mb(con):
+    """
+    Retorna a memória em uso pelo DuckDB em MB, por tipo (ex.: IN_MEMORY_TABLE para as
+    tabelas de staging, HASH_TABLE, ORDER_BY), e o total em 'TOTAL'.
+    """
+    memoria = dict(con.execute('''
+        SELECT tag, round(memory_usage_bytes / 1048576, 1) FROM duckdb_memory()
+        WHERE memory_usage_bytes > 0 ORDER BY memory_usage_bytes DESC;
+    ''').fetchall())
+    memoria['TOTAL'] = round(sum(memoria.values()), 1)
+    return memoria
+
+def limite_memoria_mb(con):
+    """Retorna o memory_limit da conexão em MB (o DuckDB o informa formatado, ex.: '286.1 MiB')."""
+    valor, unidade = con.execute("SELECT current_setting('memory_limit')").fetchone()[0].split()
+    return float(valor) * {'bytes': 2 ** -20, 'KiB': 2 ** -10, 'MiB': 1, 'GiB': 2 ** 10, 'TiB': 2 ** 20}[unidade]
+
+def plano_consulta(con, sql, parametros=None):
+    """
+    Executa a consulta com EXPLAIN ANALYZE e retorna o perfil do DuckDB em JSON
+    (árvore de operadores com tempos, cardinalidades e memória).
+    """
+    linha = con.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql_com_parametros(sql.strip().rstrip(';'), parametros)}").fetchone()
+    return json.loads(linha[1])
+
+def gravar_perfil(arquivo, perfil, inicio, argumentos):
+    """Grava o relatório de execução (etapas medidas e ambiente) em JSON."""
+    pico = pico_memoria_mb()
+    relatorio = {
+        'inicio': inicio.isoformat(timespec='seconds'),
+        'total_segundos': round((datetime.now() - inicio).total_seconds(), 4),
+        'pico_rss_mb': round(pico, 1) if pico is not None else None,
+        'python': sys.version.split()[0],
+        'duckdb': duckdb.__version__,
+        'argumentos': argumentos,
+        'etapas': perfil,
     }
-    if any(v is None for v in enade_cols.values()):
-        raise ValueError(f"Uma ou mais colunas não foram encontradas no arquivo ENADE. Verifique os nomes: {enade_cols}")
-
-    df_enade = df_enade[df_enade[enade_cols['faixa']] != 'SC']
-    df_enade.dropna(subset=[enade_cols['uf']], inplace=True)
-    colunas_essenciais = [
-        enade_cols['fg_bruta'], enade_cols['fg_pad'], enade_cols['ce_bruta'], 
-        enade_cols['ce_pad'], enade_cols['continua'], enade_cols['faixa'], enade_cols['sigla_ies']
-    ]
-    df_enade.dropna(subset=colunas_essenciais, inplace=True)
-    df_enade = df_enade.reset_index(drop=True)
-
-    df_curso_final = pd.DataFrame()
-    df_curso_final['NOME_IES'] = df_enade[enade_cols['nome_ies']]
-    df_curso_final['SIGLA_IES'] = df_enade[enade_cols['sigla_ies']]
-    df_curso_final['CODIGO_IES'] = df_enade[enade_cols['cod_ies']]
-    df_curso_final['NOME_CURSO'] = df_enade[enade_cols['nome_curso']].str.slice(0, 200)
-    df_curso_final['TOTAL_INSCRITOS'] = pd.to_numeric(df_enade[enade_cols['inscritos']], errors='coerce')
-    df_curso_final['TOTAL_CONCLUINTES'] = pd.to_numeric(df_enade[enade_cols['concluintes']], errors='coerce')
-    df_curso_final['NOTA_BRUTA_CE'] = str_to_float(df_enade[enade_cols['ce_bruta']])
-    df_curso_final['NOTA_PADRONIZADA_CE'] = str_to_float(df_enade[enade_cols['ce_pad']])
-    df_curso_final['NOTA_BRUTA_FG'] = str_to_float(df_enade[enade_cols['fg_bruta']])
-    df_curso_final['NOTA_PADRONIZADA_FG'] = str_to_float(df_enade[enade_cols['fg_pad']])
-    df_curso_final['NOTA_ENADE_CONTINUA'] = str_to_float(df_enade[enade_cols['continua']])
-    df_curso_final['NOTA_ENADE_FAIXA'] = pd.to_numeric(df_enade[enade_cols['faixa']], errors='coerce')
-    df_curso_final['ANO_ENADE'] = df_enade[enade_cols['ano']]
-    df_curso_final['SIGLA_UF'] = df_enade[enade_cols['uf']]
-    df_curso_final['NOME_MUNICIPIO'] = df_enade[enade_cols['municipio']]
-    df_curso_final = df_curso_final.drop_duplicates(subset=['CODIGO_IES', 'NOME_CURSO', 'ANO_ENADE'])
-    
-    # --- 3. Criar e Popular Tabela Municipio ---
-    # Obter municípios únicos das escolas e cursos
-    municipios_escola = df_escola_final[['SIGLA_UF', 'NOME_MUNICIPIO']].drop_duplicates()
-    municipios_curso = df_curso_final[['SIGLA_UF', 'NOME_MUNICIPIO']].drop_duplicates()
-    
-    # Combinar todos os municípios
-    df_municipio = pd.concat([municipios_escola, municipios_curso]).drop_duplicates()
-    
-    # Usa a função get_uf_full_name para obter o nome completo da UF
-    df_municipio['NOME_UF'] = df_municipio['SIGLA_UF'].apply(get_uf_full_name)
-    
-    df_municipio_final = df_municipio[['SIGLA_UF', 'NOME_UF', 'NOME_MUNICIPIO']]
-    df_municipio_final.dropna(subset=['SIGLA_UF', 'NOME_MUNICIPIO'], inplace=True)
-    
-    con.register('df_municipio_final', df_municipio_final)
-    con.execute("INSERT INTO Municipio SELECT * FROM df_municipio_final")
-
-    # --- 4. Inserir dados nas tabelas Escola e Curso ---
-    df_escola_final = df_escola_final.merge(df_municipio_final[['SIGLA_UF', 'NOME_MUNICIPIO']], on=['SIGLA_UF', 'NOME_MUNICIPIO'], how='inner')
-    con.register('df_escola_para_inserir', df_escola_final)
-    colunas_escola_db = [desc[0] for desc in con.execute("DESCRIBE Escola").fetchall()]
-    con.execute(f"INSERT INTO Escola SELECT {','.join(colunas_escola_db)} FROM df_escola_para_inserir")
-    
-    df_curso_final = df_curso_final.merge(df_municipio_final[['SIGLA_UF', 'NOME_MUNICIPIO']], on=['SIGLA_UF', 'NOME_MUNICIPIO'], how='inner')
-    con.register('df_curso_para_inserir', df_curso_final)
-    colunas_curso_db = [desc[0] for desc in con.execute("DESCRIBE Curso").fetchall()]
-    con.execute(f"INSERT INTO Curso SELECT {','.join(colunas_curso_db)} FROM df_curso_para_inserir")
+    with open(arquivo, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, ensure_ascii=False, indent=2, default=str)
 
-def salvar_resultado_txt(resultado_df, titulo, arquivo_txt):
+def paginas_txt(resultado, tamanho_pagina=TAMANHO_PAGINA_TXT):
     """
-    Salva o resultado de uma consulta em um arquivo de texto.
+    Formata o resultado (relação DuckDB ou DataFrame) como texto, em páginas de até
+    `tamanho_pagina` linhas, cada uma com o cabeçalho das colunas. A relação é lida
+    aos poucos (fetch_df_chunk), então só uma página fica em memória por vez.
     """
-    with open(arquivo_txt, 'a', encoding='utf-8') as f:
-        f.write(f"\n{'='*80}\n")
-        f.write(f"{titulo}\n")
-        f.write(f"{'='*80}\n")
-        f.write(resultado_df.to_string(index=False))
-        f.write(f"\n{'='*80}\n\n")
+    if not isinstance(resultado, duckdb.DuckDBPyRelation):
+        yield resultado.to_string(index=False)
+        return
+    vetores = max(tamanho_pagina // duckdb.__standard_vector_size__, 1)
+    pagina = resultado.fetch_df_chunk(vetores)
+    yield pagina.to_string(index=False)
+    while len(pagina := resultado.fetch_df_chunk(vetores)):
+        yield pagina.to_string(index=False)
 
-def main():
+def escrever_resultado_txt(saida, resultado, titulo):
     """
-    Função principal que orquestra todo o processo.
+    Escreve o resultado de uma consulta, com o título, em um arquivo de texto já aberto.
     """
-    con = duckdb.connect(database=DB_FILE, read_only=False)
-    
-    criar_tabelas(con)
-    carregar_dados(con)
-    
-    # Nome do arquivo de saída
-    arquivo_resultados = 'resultados_consultas.txt'
-    # Limpar arquivo de resultados se existir
-    with open(arquivo_resultados, 'w', encoding='utf-8') as f:
-        f.write("="*80)
-    
+    saida.write(f"\n{'='*80}\n")
+    saida.write(f"{titulo}\n")
+    saida.write(f"{'='*80}\n")
+    saida.write("\n\n".join(paginas_txt(resultado)))
+    saida.write(f"\n{'='*80}\n\n")
+
+# --- Consultas dos relatórios ---
+# Registro das consultas: cada uma tem um nome, o título exibido e o SQL; 'parametros',
+# se presente, declara os parâmetros nomeados ($nome) do SQL com seus valores padrão,
+# 'titulo_arquivo' substitui o título em resultados_consultas.txt e 'sql_aproximado' é
+# a variante usada no modo aproximado (estimativas com margens de erro de 95%). As
+# colunas do resultado usam tipos que o Parquet guarda sem conversão (VARCHAR no lugar
+# de ENUM; DOUBLE no lugar de HUGEINT, como o relatório sempre mostrou as somas), para
+# que o resultado tenha o mesmo esquema com e sem o cache de consultas. Novas consultas
+# entram no relatório por registrar_consulta.
+# Partes comuns das variantes exata e aproximada da consulta 1: média e extremos do IDEB
+# por UF (uf), mediana exata (mediana) e as colunas do resultado tiradas delas
+SQL_IDEB_POR_UF = """uf AS (
+        SELECT 
+            SIGLA_UF,
+            SUM(SOMA_IDEB) / SUM(QTD_IDEB) as media,
+            MIN(MIN_IDEB) as minimo,
+            MAX(MAX_IDEB) as maximo
+        FROM AgregadoUfAno
+        WHERE ANO_ESCOLA BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
+        GROUP BY SIGLA_UF
+    )"""
+SQL_MEDIANA_POR_UF = """-- Mediana exata a partir do histograma: PERCENTILE_CONT(0.5) interpola entre as
+    -- notas nas posições floor((n-1)/2) e ceil((n-1)/2)
+    histograma AS (
+        SELECT SIGLA_UF, IDEB_NOTA, SUM(QTD) as qtd
+        FROM HistogramaIdeb
+        WHERE ANO_ESCOLA BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
+        GROUP BY SIGLA_UF, IDEB_NOTA
+    ),
+    posicoes AS (
+        SELECT 
+            SIGLA_UF,
+            IDEB_NOTA,
+            SUM(qtd) OVER (PARTITION BY SIGLA_UF ORDER BY IDEB_NOTA) - qtd as inicio,
+            SUM(qtd) OVER (PARTITION BY SIGLA_UF ORDER BY IDEB_NOTA) as fim,
+            (SUM(qtd) OVER (PARTITION BY SIGLA_UF) - 1) / 2 as meio
+        FROM histograma
+    ),
+    mediana AS (
+        SELECT 
+            SIGLA_UF,
+            MAX(IDEB_NOTA) FILTER (WHERE inicio <= FLOOR(meio) AND FLOOR(meio) < fim) as nota_inferior,
+            MAX(IDEB_NOTA) FILTER (WHERE inicio <= CEIL(meio) AND CEIL(meio) < fim) as nota_superior
+        FROM posicoes
+        GROUP BY SIGLA_UF
+    )"""
+SQL_COLUNAS_UF = """
+        u.SIGLA_UF::VARCHAR as SIGLA_UF,
+        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = u.SIGLA_UF LIMIT 1)::VARCHAR as NOME_UF,
+        ROUND(u.media, 3) as "IDEB Médio\""""
+SQL_COLUNAS_NOTAS_UF = """ROUND(u.minimo, 3) as "IDEB Mínimo",
+        ROUND(u.maximo, 3) as "IDEB Máximo",
+        ROUND(md.nota_inferior + (md.nota_superior - md.nota_inferior) * 0.5, 3) as "IDEB Mediana\""""
+
+CONSULTAS = [
     # CONSULTA 1: Ranking de Estados por Performance IDEB
-    print("\n1. RANKING DE ESTADOS POR PERFORMANCE IDEB")
-    print("-"*60)
-    query1 = """
-    SELECT 
-        SIGLA_UF,
-        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = Escola.SIGLA_UF LIMIT 1) as NOME_UF,
-        ROUND(AVG(IDEB_NOTA), 3) as "IDEB Médio",
-        COUNT(DISTINCT CODIGO_ESCOLA) as "Total Escolas",
-        ROUND(MIN(IDEB_NOTA), 3) as "IDEB Mínimo",
-        ROUND(MAX(IDEB_NOTA), 3) as "IDEB Máximo",
-        ROUND(PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY IDEB_NOTA), 3) as "IDEB Mediana"
-    FROM Escola 
-    WHERE IDEB_NOTA IS NOT NULL
-    GROUP BY SIGLA_UF
-    ORDER BY AVG(IDEB_NOTA) DESC
-    LIMIT 10;
-    """
-    result1 = con.execute(query1).df()
-    print(result1.to_string(index=False))
-    salvar_resultado_txt(result1, "1. RANKING DE ESTADOS POR PERFORMANCE IDEB", arquivo_resultados)
-    
+    {
+        'nome': 'ranking_estados_ideb',
+        'titulo': "1. RANKING DE ESTADOS POR PERFORMANCE IDEB",
+        'parametros': {'limite': 10, 'ano_inicio': None, 'ano_fim': None},
+        'sql': f"""
+    WITH {SQL_IDEB_POR_UF},
+    escolas AS (
+        SELECT SIGLA_UF, COUNT(DISTINCT CODIGO_ESCOLA) as total_escolas
+        FROM AgregadoEscola
+        WHERE len(list_filter(ANOS, a -> a BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999))) > 0
+        GROUP BY SIGLA_UF
+    ),
+    {SQL_MEDIANA_POR_UF}
+    SELECT {SQL_COLUNAS_UF},
+        e.total_escolas as "Total Escolas",
+        {SQL_COLUNAS_NOTAS_UF}
+    FROM uf u
+    JOIN escolas e ON e.SIGLA_UF = u.SIGLA_UF
+    JOIN mediana md ON md.SIGLA_UF = u.SIGLA_UF
+    ORDER BY u.media DESC
+    LIMIT $limite;
+    """,
+        # Total de escolas estimado pela AmostraEscola; média, extremos e mediana seguem exatos
+        'sql_aproximado': f"""
+    WITH {SQL_IDEB_POR_UF},
+    -- Em cada UF, as n escolas da amostra (fração f) e, entre elas, as k avaliadas no
+    -- período: o total é estimado por k / f, com margem de 95% de Agresti-Coull e correção
+    -- de população finita, 1.96 * (n / f) * sqrt((1 - f) * p * (1 - p) / (n + 4)), com
+    -- p = (k + 2) / (n + 4) (sem margem nula quando todas ou nenhuma das escolas contam)
+    amostra AS (
+        SELECT
+            SIGLA_UF,
+            ANY_VALUE(FRACAO) as f,
+            COUNT(*) as n,
+            COUNT(*) FILTER (WHERE len(list_filter(ANOS, a -> a BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999))) > 0) as k
+        FROM AmostraEscola
+        GROUP BY SIGLA_UF
+    ),
+    {SQL_MEDIANA_POR_UF}
+    SELECT {SQL_COLUNAS_UF},
+        ROUND(COALESCE(a.k / a.f, 0))::BIGINT as "Total Escolas",
+        ROUND(COALESCE(1.96 * (a.n / a.f) * SQRT((1 - a.f) * ((a.k + 2) / (a.n + 4)) * (1 - (a.k + 2) / (a.n + 4)) / (a.n + 4)), 0))::BIGINT as "± Escolas (95%)",
+        {SQL_COLUNAS_NOTAS_UF}
+    FROM uf u
+    LEFT JOIN amostra a ON a.SIGLA_UF = u.SIGLA_UF
+    JOIN mediana md ON md.SIGLA_UF = u.SIGLA_UF
+    ORDER BY u.media DESC
+    LIMIT $limite;
+    """,
+    },
     # CONSULTA 2: Top Cursos por Nota ENADE
-    print("\n\n2. TOP CURSOS POR NOTA ENADE")
-    print("-"*60)
-    query2 = """
+    {
+        'nome': 'top_cursos_enade',
+        'titulo': "2. TOP CURSOS POR NOTA ENADE",
+        'parametros': {'limite': 15, 'min_ofertas': 30, 'ano_inicio': None, 'ano_fim': None},
+        'sql': """
     WITH cursos_stats AS (
         SELECT 
             NOME_CURSO,
-            AVG(NOTA_ENADE_CONTINUA) as nota_media,
-            COUNT(*) as total_ofertas,
-            COUNT(DISTINCT SIGLA_UF) as estados_presentes,
-            COUNT(DISTINCT CODIGO_IES) as ies_diferentes,
-            SUM(TOTAL_INSCRITOS) as total_inscritos_geral
-        FROM Curso 
-        WHERE NOTA_ENADE_CONTINUA IS NOT NULL
+            SUM(SOMA_ENADE) / SUM(QTD_ENADE) as nota_media,
+            SUM(QTD_ENADE)::BIGINT as total_ofertas,
+            len(list_distinct(flatten(LIST(UFS)))) as estados_presentes,
+            len(list_distinct(flatten(LIST(IES)))) as ies_diferentes,
+            SUM(SOMA_INSCRITOS) as total_inscritos_geral
+        FROM AgregadoCursoAno
+        WHERE ANO_ENADE BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
         GROUP BY NOME_CURSO
-        HAVING COUNT(*) >= 30  -- Cursos com pelo menos 30 ofertas
+        HAVING SUM(QTD_ENADE) >= $min_ofertas  -- Cursos com um mínimo de ofertas (padrão: 30)
     )
     SELECT 
         NOME_CURSO as "Nome do Curso",
@@ -359,33 +1831,66 @@ def main():
         total_ofertas as "Total Ofertas",
         estados_presentes as "Estados Presentes", 
         ies_diferentes as "IES Diferentes",
-        total_inscritos_geral as "Total Inscritos"
+        total_inscritos_geral::DOUBLE as "Total Inscritos"
     FROM cursos_stats
     ORDER BY nota_media DESC
-    LIMIT 15;
-    """
-    result2 = con.execute(query2).df()
-    print(result2.to_string(index=False))
-    salvar_resultado_txt(result2, "2. TOP CURSOS POR NOTA ENADE", arquivo_resultados)
-    
+    LIMIT $limite;
+    """,
+        # IES distintas por HyperLogLog (approx_count_distinct), sem unir as listas de IES
+        'sql_aproximado': f"""
+    WITH cursos_stats AS (
+        SELECT 
+            NOME_CURSO,
+            SUM(SOMA_ENADE) / SUM(QTD_ENADE) as nota_media,
+            SUM(QTD_ENADE)::BIGINT as total_ofertas,
+            len(list_distinct(flatten(LIST(UFS)))) as estados_presentes,
+            SUM(SOMA_INSCRITOS) as total_inscritos_geral
+        FROM AgregadoCursoAno
+        WHERE ANO_ENADE BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
+        GROUP BY NOME_CURSO
+        HAVING SUM(QTD_ENADE) >= $min_ofertas  -- Cursos com um mínimo de ofertas (padrão: 30)
+    ),
+    cursos_ies AS (
+        SELECT NOME_CURSO, approx_count_distinct(ies) as ies_diferentes
+        FROM (
+            SELECT NOME_CURSO, unnest(IES) as ies
+            FROM AgregadoCursoAno
+            WHERE ANO_ENADE BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
+        )
+        GROUP BY NOME_CURSO
+    )
+    SELECT 
+        c.NOME_CURSO as "Nome do Curso",
+        ROUND(c.nota_media, 3) as "Nota ENADE Média",
+        c.total_ofertas as "Total Ofertas",
+        c.estados_presentes as "Estados Presentes", 
+        i.ies_diferentes as "IES Diferentes",
+        ROUND(1.96 * {ERRO_RELATIVO_HLL} * i.ies_diferentes)::BIGINT as "± IES (95%)",
+        c.total_inscritos_geral::DOUBLE as "Total Inscritos"
+    FROM cursos_stats c
+    JOIN cursos_ies i ON i.NOME_CURSO = c.NOME_CURSO
+    ORDER BY c.nota_media DESC
+    LIMIT $limite;
+    """,
+    },
     # CONSULTA 3: Análise Temporal do IDEB
-    print("\n\n3. EVOLUÇÃO TEMPORAL DO IDEB POR ESTADO")
-    print("-"*60)
-    query3 = """
+    {
+        'nome': 'evolucao_ideb_estados',
+        'titulo': "3. EVOLUÇÃO TEMPORAL DO IDEB POR ESTADO",
+        'sql': """
     WITH evolucao_temporal AS (
         SELECT 
             SIGLA_UF,
-            AVG(CASE WHEN ANO_ESCOLA = 2017 THEN IDEB_NOTA END) as ideb_2017,
-            AVG(CASE WHEN ANO_ESCOLA = 2019 THEN IDEB_NOTA END) as ideb_2019,
-            AVG(CASE WHEN ANO_ESCOLA = 2021 THEN IDEB_NOTA END) as ideb_2021,
-            AVG(CASE WHEN ANO_ESCOLA = 2023 THEN IDEB_NOTA END) as ideb_2023
-        FROM Escola
-        WHERE IDEB_NOTA IS NOT NULL
+            SUM(SOMA_IDEB) FILTER (WHERE ANO_ESCOLA = 2017) / SUM(QTD_IDEB) FILTER (WHERE ANO_ESCOLA = 2017) as ideb_2017,
+            SUM(SOMA_IDEB) FILTER (WHERE ANO_ESCOLA = 2019) / SUM(QTD_IDEB) FILTER (WHERE ANO_ESCOLA = 2019) as ideb_2019,
+            SUM(SOMA_IDEB) FILTER (WHERE ANO_ESCOLA = 2021) / SUM(QTD_IDEB) FILTER (WHERE ANO_ESCOLA = 2021) as ideb_2021,
+            SUM(SOMA_IDEB) FILTER (WHERE ANO_ESCOLA = 2023) / SUM(QTD_IDEB) FILTER (WHERE ANO_ESCOLA = 2023) as ideb_2023
+        FROM AgregadoUfAno
         GROUP BY SIGLA_UF
     )
     SELECT 
-        e.SIGLA_UF,
-        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = e.SIGLA_UF LIMIT 1) as "Estado",
+        e.SIGLA_UF::VARCHAR as SIGLA_UF,
+        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = e.SIGLA_UF LIMIT 1)::VARCHAR as "Estado",
         ROUND(e.ideb_2017, 3) as "IDEB 2017",
         ROUND(e.ideb_2019, 3) as "IDEB 2019",
         ROUND(e.ideb_2021, 3) as "IDEB 2021", 
@@ -399,30 +1904,23 @@ def main():
     FROM evolucao_temporal e
     WHERE e.ideb_2017 IS NOT NULL AND e.ideb_2023 IS NOT NULL
     ORDER BY "Variação 2017-2023" DESC;
-    """
-    result3 = con.execute(query3).df()
-    print(result3.to_string(index=False))
-    salvar_resultado_txt(result3, "3. EVOLUÇÃO TEMPORAL DO IDEB POR ESTADO", arquivo_resultados)
-    
+    """,
+    },
     # CONSULTA 4: Análise Comparativa das Categorias de IES
-    print("\n\n4. ANÁLISE COMPARATIVA DAS CATEGORIAS DE IES")
-    print("-"*60)
-    query4 = """
+    {
+        'nome': 'categorias_ies',
+        'titulo': "4. ANÁLISE COMPARATIVA DAS CATEGORIAS DE IES",
+        'parametros': {'limite': 20, 'ano_inicio': None, 'ano_fim': None},
+        'sql': """
     WITH ies_por_categoria AS (
         SELECT 
             SIGLA_UF,
-            CASE 
-                WHEN UPPER(NOME_IES) LIKE '%FEDERAL%' OR UPPER(NOME_IES) LIKE '%UNIVERSIDADE FEDERAL%' 
-                     OR UPPER(NOME_IES) LIKE '%INSTITUTO FEDERAL%' THEN 'Pública Federal'
-                WHEN UPPER(NOME_IES) LIKE '%FUNDAÇÃO%' OR UPPER(NOME_IES) LIKE '%FILANTRÓPICA%'
-                     OR UPPER(NOME_IES) LIKE '%BENEFICENTE%' THEN 'Privada sem fins lucrativos'
-                ELSE 'Privada com fins lucrativos'
-            END as categoria_ies,
-            COUNT(DISTINCT CODIGO_IES) as total_ies,
-            AVG(NOTA_ENADE_CONTINUA) as enade_medio
-        FROM Curso
-        WHERE NOTA_ENADE_CONTINUA IS NOT NULL
-        GROUP BY SIGLA_UF, categoria_ies
+            CATEGORIA_IES as categoria_ies,
+            len(list_distinct(flatten(LIST(IES)))) as total_ies,
+            SUM(SOMA_ENADE) / SUM(QTD_ENADE) as enade_medio
+        FROM AgregadoCategoriaIes
+        WHERE ANO_ENADE BETWEEN COALESCE($ano_inicio, 0) AND COALESCE($ano_fim, 9999)
+        GROUP BY SIGLA_UF, CATEGORIA_IES
     ),
     ies_consolidado AS (
         SELECT 
@@ -437,8 +1935,8 @@ def main():
         GROUP BY SIGLA_UF
     )
     SELECT 
-        i.SIGLA_UF,
-        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = i.SIGLA_UF LIMIT 1) as "Estado",
+        i.SIGLA_UF::VARCHAR as SIGLA_UF,
+        (SELECT NOME_UF FROM Municipio m WHERE m.SIGLA_UF = i.SIGLA_UF LIMIT 1)::VARCHAR as "Estado",
         COALESCE(i.ies_publica_federal, 0) as "IES Públ Fed",
         COALESCE(i.ies_privada_sem_fins, 0) as "IES Priv S/Fins",
         COALESCE(i.ies_privada_com_fins, 0) as "IES Priv C/Fins",
@@ -448,62 +1946,556 @@ def main():
     FROM ies_consolidado i
     WHERE (i.ies_publica_federal > 0 OR i.ies_privada_sem_fins > 0 OR i.ies_privada_com_fins > 0)
     ORDER BY COALESCE(i.enade_publica_federal, 0) DESC, COALESCE(i.enade_privada_sem_fins, 0) DESC
-    LIMIT 20;
-    """
-    result4 = con.execute(query4).df()
-    print(result4.to_string(index=False))
-    salvar_resultado_txt(result4, "4. ANÁLISE COMPARATIVA DAS CATEGORIAS DE IES", arquivo_resultados)
-    
+    LIMIT $limite;
+    """,
+    },
     # CONSULTA 5: Distribuição Geográfica das Escolas por Qualidade
-    print("\n\n5. DISTRIBUIÇÃO GEOGRÁFICA DAS ESCOLAS POR QUALIDADE")
-    print("-"*60)
-    query5 = """
+    {
+        'nome': 'qualidade_escolas_municipio',
+        'titulo': "5. DISTRIBUIÇÃO GEOGRÁFICA DAS ESCOLAS POR QUALIDADE",
+        'titulo_arquivo': "5. DISTRIBUIÇÃO GEOGRÁFICA DAS ESCOLAS POR QUALIDADE (POR MUNICÍPIO)",
+        'parametros': {'min_anos': 2},
+        'sql': """
     WITH escolas_qualidade AS (
         SELECT 
             CODIGO_ESCOLA,
             NOME_ESCOLA,
             SIGLA_UF,
-            NOME_MUNICIPIO,
+            ID_MUNICIPIO,
             REDE_ESCOLA,
-            AVG(IDEB_NOTA) as nota_media_escola,
-            AVG(SAEB_NOTA_MAT) as saeb_mat_medio,
-            AVG(SAEB_NOTA_PORT) as saeb_port_medio,
-            COUNT(DISTINCT ANO_ESCOLA) as anos_avaliados,
+            SOMA_IDEB / QTD_IDEB as nota_media_escola,
+            SOMA_SAEB_MAT / QTD_SAEB_MAT as saeb_mat_medio,
+            SOMA_SAEB_PORT / QTD_SAEB_PORT as saeb_port_medio,
+            len(ANOS) as anos_avaliados,
             CASE 
-                WHEN AVG(IDEB_NOTA) >= 6.0 THEN 'Excelente'
-                WHEN AVG(IDEB_NOTA) >= 5.0 THEN 'Boa'
-                WHEN AVG(IDEB_NOTA) >= 4.0 THEN 'Regular'
+                WHEN SOMA_IDEB / QTD_IDEB >= 6.0 THEN 'Excelente'
+                WHEN SOMA_IDEB / QTD_IDEB >= 5.0 THEN 'Boa'
+                WHEN SOMA_IDEB / QTD_IDEB >= 4.0 THEN 'Regular'
                 ELSE 'Baixa'
             END as categoria_qualidade
-        FROM Escola
-        WHERE IDEB_NOTA IS NOT NULL
-        GROUP BY CODIGO_ESCOLA, NOME_ESCOLA, SIGLA_UF, NOME_MUNICIPIO, REDE_ESCOLA
-        HAVING COUNT(DISTINCT ANO_ESCOLA) >= 2  -- Escolas com pelo menos 2 anos de avaliação
+        FROM AgregadoEscola
+        WHERE len(ANOS) >= $min_anos  -- Escolas com pelo menos 2 anos de avaliação (padrão)
     ),
     distribuicao_por_municipio AS (
         SELECT 
             SIGLA_UF,
-            NOME_MUNICIPIO,
+            ID_MUNICIPIO,
             categoria_qualidade,
             COUNT(*) as qtd_escolas,
             AVG(nota_media_escola) as nota_media_categoria
         FROM escolas_qualidade
-        GROUP BY SIGLA_UF, NOME_MUNICIPIO, categoria_qualidade
+        GROUP BY SIGLA_UF, ID_MUNICIPIO, categoria_qualidade
     )
     SELECT 
-        d.SIGLA_UF as "UF",
-        d.NOME_MUNICIPIO as "Município",
+        d.SIGLA_UF::VARCHAR as "UF",
+        m.NOME_MUNICIPIO as "Município",
         d.categoria_qualidade as "Categoria",
         d.qtd_escolas as "Qtd Escolas",
         ROUND(d.nota_media_categoria, 3) as "IDEB Médio"
     FROM distribuicao_por_municipio d
-    
-    ORDER BY d.nota_media_categoria DESC, d.qtd_escolas DESC;
+    JOIN Municipio m ON m.ID_MUNICIPIO = d.ID_MUNICIPIO
+    ORDER BY "IDEB Médio" DESC, d.qtd_escolas DESC, d.SIGLA_UF, m.NOME_MUNICIPIO;
+    """,
+    },
+]
+
+def registrar_consulta(nome, titulo, sql, parametros=None, titulo_arquivo=None, sql_aproximado=None):
+    """
+    Acrescenta uma consulta ao registro CONSULTAS, que passa a fazer parte do relatório.
+    `parametros` declara os parâmetros nomeados ($nome) do SQL com seus valores padrão
+    e `sql_aproximado`, opcional, é a variante do modo aproximado.
+    Levanta ValueError se já houver uma consulta com o mesmo nome.
+    """
+    if any(c['nome'] == nome for c in CONSULTAS):
+        raise ValueError(f"Consulta já registrada: {nome}")
+    consulta = {'nome': nome, 'titulo': titulo, 'sql': sql}
+    if parametros:
+        consulta['parametros'] = dict(parametros)
+    if titulo_arquivo:
+        consulta['titulo_arquivo'] = titulo_arquivo
+    if sql_aproximado:
+        consulta['sql_aproximado'] = sql_aproximado
+    CONSULTAS.append(consulta)
+    return consulta
+
+def sql_consulta(consulta, aproximado=False):
+    """
+    SQL a executar para a consulta: no modo aproximado, a variante 'sql_aproximado',
+    se houver; as consultas sem variante são sempre exatas.
+    """
+    return consulta.get('sql_aproximado', consulta['sql']) if aproximado else consulta['sql']
+
+def titulo_consulta(consulta, aproximado=False, arquivo=False):
+    """Título da consulta no relatório (na tela ou no arquivo), marcado quando aproximado."""
+    titulo = consulta.get('titulo_arquivo', consulta['titulo']) if arquivo else consulta['titulo']
+    return f"{titulo} (APROXIMADO)" if aproximado and 'sql_aproximado' in consulta else titulo
+
+def parametros_consulta(consulta, parametros=None):
+    """
+    Valores dos parâmetros de uma consulta: os padrões declarados por ela, substituídos
+    pelos de `parametros` que ela declara (os demais são ignorados).
+    """
+    valores = dict(consulta.get('parametros', {}))
+    valores.update({nome: valor for nome, valor in (parametros or {}).items() if nome in valores})
+    return valores or None
+
+def executar_relatorio(con, consultas=None, parametros=None, usar_cache=True, threads=None, perfil=None, aproximado=False):
+    """
+    Executa as consultas (por padrão, todo o registro CONSULTAS) em um pool de threads,
+    cada uma em um cursor próprio da conexão. Gera os pares (consulta, resultado) na
+    ordem do registro à medida que ficam prontos, para que a saída de uma consulta seja
+    escrita enquanto as seguintes ainda executam. O resultado é uma relação DuckDB sobre
+    o Parquet gravado pela consulta (no cache de consultas ou, sem usar_cache, em um
+    diretório temporário removido ao fim do gerador), lida em lotes por quem a consome.
+    Com aproximado, as consultas que têm variante aproximada a usam (ver sql_consulta).
+    Com perfil, cada consulta é medida e recebe o plano do EXPLAIN ANALYZE (ver
+    plano_consulta).
+    """
+    consultas = CONSULTAS if consultas is None else consultas
+
+    def executar(consulta, temporario):
+        cursor = con.cursor()
+        try:
+            valores = parametros_consulta(consulta, parametros)
+            sql = sql_consulta(consulta, aproximado)
+            with medir_etapa(perfil, f"consulta.{consulta['nome']}") as etapa:
+                if usar_cache:
+                    arquivo = arquivo_consulta(cursor, sql, valores)
+                else:
+                    arquivo = os.path.join(temporario, f"{consulta['nome']}.parquet")
+                    gravar_cache(cursor, sql_com_parametros(sql.strip().rstrip(';'), valores), arquivo)
+            if perfil is not None:
+                etapa['linhas'] = cursor.execute(f"SELECT COUNT(*) FROM read_parquet({sql_texto(arquivo)});").fetchone()[0]
+                etapa['parametros'] = valores
+                etapa['aproximada'] = aproximado and 'sql_aproximado' in consulta
+                etapa['plano'] = plano_consulta(cursor, sql, valores)
+            return arquivo
+        finally:
+            cursor.close()
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory(prefix='relatorio_') as temporario, \
+            ThreadPoolExecutor(max_workers=threads or max(len(consultas), 1)) as pool:
+        futuros = [pool.submit(executar, consulta, temporario) for consulta in consultas]
+        for consulta, futuro in zip(consultas, futuros):
+            yield consulta, con.read_parquet(futuro.result())
+
+def ler_parametros(pares):
+    """Converte pares 'nome=valor' da linha de comando em dicionário (valores em JSON ou texto)."""
+    parametros = {}
+    for par in pares or []:
+        nome, separador, valor = par.partition('=')
+        if not separador:
+            raise ValueError(f"Parâmetro inválido (use nome=valor): {par}")
+        try:
+            parametros[nome] = json.loads(valor)
+        except json.JSONDecodeError:
+            parametros[nome] = valor
+    return parametros
+
+# --- Exportação dos resultados ---
+def escrever_csv(relacao, saida, tamanho_bloco=10_000):
+    """Escreve uma relação DuckDB como CSV em um arquivo de texto aberto, em blocos de linhas."""
+    import csv
+
+    escritor = csv.writer(saida, lineterminator='\n')
+    escritor.writerow(relacao.columns)
+    while linhas := relacao.fetchmany(tamanho_bloco):
+        escritor.writerows(linhas)
+
+def escrever_arrow(relacao, saida, arquivo=True, tamanho_lote=TAMANHO_LOTE_EXPORTACAO):
+    """
+    Escreve uma relação DuckDB em Arrow IPC, lote a lote (RecordBatch): no formato de
+    arquivo, ou no formato de stream (arquivo=False), que pode ir para a saída padrão.
+    """
+    import pyarrow as pa
+
+    lotes = relacao.to_arrow_reader(tamanho_lote)
+    novo_escritor = pa.ipc.new_file if arquivo else pa.ipc.new_stream
+    with novo_escritor(saida, lotes.schema) as escritor:
+        for lote in lotes:
+            escritor.write_batch(lote)
+
+def exportar_resultado(relacao, destino=None, formato=None, titulo=None):
+    """
+    Exporta o resultado de uma consulta (relação DuckDB) para `destino` em Parquet,
+    CSV, Arrow IPC ou texto (txt, paginado), sem montar um DataFrame com o resultado
+    inteiro: Parquet e CSV são escritos pelo próprio DuckDB, Arrow e txt em lotes.
+    Sem destino (ou com '-'), escreve na saída padrão (CSV, stream Arrow ou txt). O
+    formato, se não for informado, vem da extensão do destino (padrão: CSV).
+    """
+    if destino == '-':
+        destino = None
+    formato = formato or FORMATOS_EXPORTACAO.get(os.path.splitext(destino or '')[1].lower(), 'csv')
+    if formato not in FORMATOS_EXPORTACAO.values():
+        raise ValueError(f"Formato de exportação desconhecido: {formato}")
+
+    if destino is None:
+        if formato == 'parquet':
+            raise ValueError("A exportação em Parquet precisa de um arquivo de destino.")
+        if formato == 'arrow':
+            sys.stdout.flush()
+            escrever_arrow(relacao, sys.stdout.buffer, arquivo=False)
+        elif formato == 'txt':
+            for pagina in paginas_txt(relacao):
+                print(pagina)
+        else:
+            escrever_csv(relacao, sys.stdout)
+        return
+
+    os.makedirs(os.path.dirname(destino) or '.', exist_ok=True)
+    if formato == 'parquet':
+        relacao.write_parquet(destino, compression='zstd')
+    elif formato == 'csv':
+        relacao.write_csv(destino, header=True)
+    elif formato == 'arrow':
+        escrever_arrow(relacao, destino)
+    else:
+        with open(destino, 'w', encoding='utf-8') as saida:
+            escrever_resultado_txt(saida, relacao, titulo or os.path.basename(destino))
+
+def conectar(escrita=False, limite_memoria=None):
+    """
+    Abre DB_FILE; sem escrita, em modo somente leitura (várias leituras simultâneas
+    e nenhuma alteração acidental). Levanta FileNotFoundError se o banco ainda não
+    foi carregado e a conexão é somente leitura.
+    """
+    if not escrita and not os.path.exists(DB_FILE):
+        raise FileNotFoundError(f"Banco {DB_FILE} não encontrado; execute 'python prog.py load' primeiro.")
+    con = duckdb.connect(database=DB_FILE, read_only=not escrita)
+    if limite_memoria:
+        con.execute(f"SET memory_limit = {sql_texto(limite_memoria)};")
+    return con
+
+def validar_carga(con, anterior=None, reducao_maxima=REDUCAO_MAXIMA_LINHAS):
+    """
+    Confere um banco recém-carregado antes de publicá-lo: Municipio, Escola e Curso não
+    podem estar vazias, os agregados devem cobrir exatamente as notas das tabelas e, se
+    houver o banco `anterior` (arquivo), nenhuma das três tabelas pode ter perdido mais
+    que `reducao_maxima` das linhas. Levanta ValueError com os problemas encontrados;
+    senão, retorna o número de linhas de cada tabela.
+    """
+    tabelas = ['Municipio', 'Escola', 'Curso']
+    contagens = {tabela: con.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0] for tabela in tabelas}
+    problemas = [f"{tabela} está vazia" for tabela, linhas in contagens.items() if linhas == 0]
+
+    ideb_ok, enade_ok = con.execute('''
+        SELECT (SELECT COALESCE(SUM(QTD_IDEB), 0) FROM AgregadoUfAno) = (SELECT COUNT(IDEB_NOTA) FROM Escola),
+               (SELECT COALESCE(SUM(QTD_ENADE), 0) FROM AgregadoCursoAno) = (SELECT COUNT(NOTA_ENADE_CONTINUA) FROM Curso)
+    ''').fetchone()
+    if not ideb_ok:
+        problemas.append("AgregadoUfAno não confere com as notas IDEB de Escola")
+    if not enade_ok:
+        problemas.append("AgregadoCursoAno não confere com as notas ENADE de Curso")
+
+    if anterior and os.path.exists(anterior):
+        atual = duckdb.connect(anterior, read_only=True)
+        try:
+            existentes = {linha[0] for linha in atual.execute("SELECT table_name FROM duckdb_tables()").fetchall()}
+            for tabela in tabelas:
+                if tabela not in existentes:
+                    continue
+                antes = atual.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0]
+                if contagens[tabela] < antes * (1 - reducao_maxima):
+                    problemas.append(f"{tabela} caiu de {antes} para {contagens[tabela]} linhas")
+        finally:
+            atual.close()
+
+    if problemas:
+        raise ValueError('; '.join(problemas))
+    return contagens
+
+def publicar_banco(sombra, destino=None, snapshots=PATH_SNAPSHOTS):
+    """
+    Troca o banco `destino` (padrão: DB_FILE) pelo banco `sombra` com os.replace, que é
+    atômico: quem abrir o banco depois da troca vê o novo, e quem já o tinha aberto
+    continua lendo o anterior até fechá-lo. O banco substituído é guardado em
+    `snapshots` (por hard link, sem cópia, quando possível) junto com o seu WAL, que é
+    movido para lá antes da troca: o DuckDB reaplicaria um `<destino>.wal` antigo sobre
+    o banco novo. O `sombra` precisa ter passado por CHECKPOINT e estar fechado, sem
+    WAL. Retorna o caminho da cópia ou None se ainda não havia banco.
+    """
+    destino = destino or DB_FILE
+    if os.path.exists(f'{sombra}.wal'):
+        raise RuntimeError(f"{sombra} ainda tem um WAL; faça CHECKPOINT e feche-o antes de publicá-lo.")
+    copia = None
+    if os.path.exists(destino):
+        os.makedirs(snapshots, exist_ok=True)
+        nome, extensao = os.path.splitext(os.path.basename(destino))
+        copia = os.path.join(snapshots, f"{nome}.{datetime.now():%Y%m%d-%H%M%S}{extensao}")
+        ligar_ou_copiar(destino, copia)
+    if os.path.exists(f'{destino}.wal'):
+        if copia:
+            os.replace(f'{destino}.wal', f'{copia}.wal')
+        else:
+            os.remove(f'{destino}.wal')  # WAL sem banco: não há o que reaplicar
+    os.replace(sombra, destino)
+    return copia
+
+def podar_snapshots(dias=RETENCAO_SNAPSHOTS_DIAS, snapshots=PATH_SNAPSHOTS):
+    """
+    Remove as cópias de bancos substituídos há mais de `dias` dias (pela data no nome),
+    com os seus WALs.
     """
-    result5 = con.execute(query5).df()
-    print(result5.to_string(index=False))
-    salvar_resultado_txt(result5, "5. DISTRIBUIÇÃO GEOGRÁFICA DAS ESCOLAS POR QUALIDADE (POR MUNICÍPIO)", arquivo_resultados)
+    limite = datetime.now().timestamp() - dias * 86400
+    removidos = []
+    for caminho in glob.glob(os.path.join(snapshots, '*')):
+        partes = os.path.basename(caminho).removesuffix('.wal').split('.')
+        try:
+            substituido = datetime.strptime(partes[-2], '%Y%m%d-%H%M%S').timestamp()
+        except (IndexError, ValueError):
+            continue  # Não é uma cópia gravada por publicar_banco
+        if substituido < limite:
+            os.remove(caminho)
+            removidos.append(caminho)
+    return removidos
+
+def carregar_em_sombra(args, perfil=None):
+    """
+    Carga azul/verde: carrega um banco sombra (DB_FILE + '.sombra'; na carga incremental,
+    uma cópia do banco atual), valida-o (validar_carga) e só então o publica no lugar de
+    DB_FILE (publicar_banco). Enquanto isso, o banco em uso continua disponível para
+    leitura. Se a carga ou a validação falharem, o banco sombra é descartado e o banco em
+    uso não muda. O lago Parquet segue o banco: o sombra grava uma versão nova do lago
+    (ver atualizar_lago), que passa a ser lida com a publicação; se o banco em uso tem o
+    lago, a carga completa também o mantém.
+    """
+    sombra = f'{DB_FILE}.sombra'
+    remover_banco(sombra)
+    if not args.lago and os.path.exists(DB_FILE):
+        atual = duckdb.connect(DB_FILE, read_only=True)
+        try:
+            args.lago = lago_ativo(atual)
+        finally:
+            atual.close()
+    if args.incremental and os.path.exists(DB_FILE):
+        with medir_etapa(perfil, 'carga.copiar_banco'):
+            shutil.copy2(DB_FILE, sombra)
+            if os.path.exists(f'{DB_FILE}.wal'):
+                # Sem o WAL, a cópia perderia as transações ainda não gravadas no arquivo
+                shutil.copy2(f'{DB_FILE}.wal', f'{sombra}.wal')
+
+    con = duckdb.connect(sombra)
+    try:
+        if args.limite_memoria:
+            con.execute(f"SET memory_limit = {sql_texto(args.limite_memoria)};")
+        comando_load(con, args, perfil)
+        with medir_etapa(perfil, 'carga.validar') as etapa:
+            etapa['linhas'] = validar_carga(con, DB_FILE)
+        con.execute("CHECKPOINT;")
+    except BaseException:
+        con.close()
+        remover_banco(sombra)
+        remover_banco(arquivo_staging(sombra))
+        podar_lago()  # A versão do lago gravada pelo sombra
+        raise
     con.close()
 
+    with medir_etapa(perfil, 'carga.publicar'):
+        copia = publicar_banco(sombra)
+        removidos = podar_snapshots(args.retencao) + podar_lago()
+    if copia:
+        print(f"Banco publicado; o anterior foi guardado em {copia}")
+    for caminho in removidos:
+        print(f"Cópia antiga removida: {caminho}")
+
+def comando_load(con, args, perfil=None):
+    """Cria as tabelas (se necessário) e carrega os arquivos de origem no banco."""
+    with medir_etapa(perfil, 'carga.criar_tabelas'):
+        criar_tabelas(con, recriar=not args.incremental)
+    carregar_dados(con, incremental=args.incremental,
+                   tamanho_lote=args.tamanho_lote if args.streaming else None,
+                   processos=args.processos, usar_cache=not args.sem_cache, perfil=perfil, lago=args.lago)
+    rejeitados = con.execute("SELECT COUNT(*) FROM Rejeitados").fetchone()[0]
+    if rejeitados:
+        print(f"Linhas recusadas pela validação: {rejeitados} (motivos na tabela Rejeitados)")
+    pico = pico_memoria_mb()
+    if pico is not None:
+        print(f"Carga concluída. Pico de memória (RSS): {pico:.1f} MB")
+        if args.limite_memoria and pico > limite_memoria_mb(con):
+            print(f"Atenção: o pico passou de --limite-memoria {args.limite_memoria}, que limita o DuckDB; "
+                  "o Python e as bibliotecas usam memória além dele.")
+
+def comando_report(con, args, perfil=None):
+    """Executa as consultas do relatório, exibe os resultados e os grava em resultados_consultas.txt."""
+    consultas = [c for c in CONSULTAS if not args.consultas or c['nome'] in args.consultas]
+    relatorio = executar_relatorio(con, consultas, args.parametros, usar_cache=not args.sem_cache_consultas,
+                                   threads=args.threads, perfil=perfil, aproximado=args.aproximado)
+
+    # Com --exportar, cada resultado vai para um arquivo próprio no diretório informado
+    if args.exportar:
+        extensao = next(e for e, f in FORMATOS_EXPORTACAO.items() if f == args.formato)
+        for consulta, resultado in relatorio:
+            destino = os.path.join(args.exportar, consulta['nome'] + extensao)
+            exportar_resultado(resultado, destino, args.formato, titulo_consulta(consulta, args.aproximado, arquivo=True))
+            print(f"{titulo_consulta(consulta, args.aproximado)}: {len(resultado)} linhas -> {destino}")
+        return
+
+    # Nome do arquivo de saída
+    arquivo_resultados = 'resultados_consultas.txt'
+    # As consultas executam em paralelo; cada resultado é escrito, na ordem do registro,
+    # assim que fica pronto
+    with open(arquivo_resultados, 'w', encoding='utf-8') as saida:
+        saida.write("="*80)
+        for i, (consulta, resultado) in enumerate(relatorio):
+            print(("\n" if i == 0 else "\n\n") + titulo_consulta(consulta, args.aproximado))
+            print("-"*60)
+            # Resultados grandes são lidos e escritos uma página por vez, na tela e no arquivo
+            saida.write(f"\n{'='*80}\n{titulo_consulta(consulta, args.aproximado, arquivo=True)}\n{'='*80}\n")
+            for j, pagina in enumerate(paginas_txt(resultado)):
+                print(pagina if j == 0 else "\n" + pagina)
+                saida.write(pagina if j == 0 else "\n\n" + pagina)
+            saida.write(f"\n{'='*80}\n\n")
+            saida.flush()
+
+def comando_query(con, args):
+    """
+    Executa uma consulta do registro (pelo nome) ou um SQL informado e exporta o
+    resultado (ver exportar_resultado), por padrão em CSV na saída padrão.
+    """
+    consulta = next((c for c in CONSULTAS if c['nome'] == args.consulta), None)
+    if consulta:
+        sql, parametros = sql_consulta(consulta, args.aproximado), parametros_consulta(consulta, args.parametros)
+    else:
+        sql, parametros = args.consulta, args.parametros or None
+    relacao = relacao_consulta(con, sql, parametros, usar_cache=not args.sem_cache_consultas)
+    exportar_resultado(relacao, args.saida, args.formato, titulo_consulta(consulta, args.aproximado) if consulta else None)
+
+def adicionar_opcoes_carga(parser):
+    parser.add_argument('--incremental', action='store_true',
+                        help="recarrega apenas os arquivos de origem alterados desde a última carga")
+    parser.add_argument('--streaming', action='store_true',
+                        help="carrega o arquivo IDEB/SAEB em lotes, sem materializá-lo inteiro")
+    parser.add_argument('--tamanho-lote', type=int, default=TAMANHO_LOTE_IDEB,
+                        help=f"registros por lote no modo --streaming (padrão: {TAMANHO_LOTE_IDEB})")
+    parser.add_argument('--processos', type=int,
+                        help="número de processos para ler os arquivos ENADE em paralelo (um arquivo por processo)")
+    parser.add_argument('--sem-cache', action='store_true',
+                        help=f"não usa o cache de staging em Parquet ({PATH_CACHE_STAGING})")
+    parser.add_argument('--sombra', action='store_true',
+                        help="carga azul/verde: carrega e valida um banco à parte e só então o troca pelo banco em uso, "
+                             "que segue disponível para leitura durante a carga")
+    parser.add_argument('--retencao', type=float, default=RETENCAO_SNAPSHOTS_DIAS, metavar='DIAS',
+                        help=f"com --sombra, dias em que os bancos substituídos ficam guardados em {PATH_SNAPSHOTS} "
+                             f"(padrão: {RETENCAO_SNAPSHOTS_DIAS})")
+    parser.add_argument('--lago', action='store_true',
+                        help=f"exporta também Escola e Curso para um lago Parquet particionado (ano=/uf=) em {PATH_LAGO}, "
+                             "exposto pelas views LagoEscola e LagoCurso; depois de criado, o lago é atualizado a cada carga")
+
+def adicionar_opcoes_consultas(parser, relatorio=True):
+    parser.add_argument('--sem-cache-consultas', action='store_true',
+                        help=f"executa as consultas sem usar o cache de resultados ({PATH_CACHE_CONSULTAS})")
+    parser.add_argument('--param', action='append', metavar='NOME=VALOR',
+                        help="valor de um parâmetro das consultas (ex.: limite=5, min_ofertas=50, ano_inicio=2022); pode ser repetido")
+    parser.add_argument('--aproximado', action='store_true',
+                        help="usa as variantes aproximadas das consultas (amostra de escolas e HyperLogLog), "
+                             "mais rápidas, com margens de erro de 95%% no resultado")
+    if relatorio:
+        parser.add_argument('--consultas', nargs='+', metavar='NOME', choices=[c['nome'] for c in CONSULTAS],
+                            help="executa apenas estas consultas do relatório (padrão: todas)")
+        parser.add_argument('--threads', type=int,
+                            help="consultas executadas em paralelo (padrão: todas ao mesmo tempo)")
+
+def adicionar_opcoes_exportacao(parser, relatorio=True):
+    formatos = sorted(set(FORMATOS_EXPORTACAO.values()))
+    if relatorio:
+        parser.add_argument('--exportar', metavar='DIRETORIO',
+                            help="grava cada resultado em DIRETORIO/<consulta>.<formato> em vez da tela e de resultados_consultas.txt")
+        parser.add_argument('--formato', choices=formatos, default='parquet',
+                            help="formato dos arquivos de --exportar (padrão: parquet)")
+    else:
+        parser.add_argument('--saida', help="arquivo de destino (.parquet, .csv, .arrow ou .txt); '-' ou omitido: saída padrão")
+        parser.add_argument('--formato', choices=formatos,
+                            help="formato da saída (padrão: pela extensão de --saida, ou csv)")
+
+def adicionar_opcoes_execucao(parser):
+    parser.add_argument('--limite-memoria',
+                        help="teto de memória do DuckDB (ex.: '2GB'); acima dele os operadores usam disco")
+    parser.add_argument('--perfil', nargs='?', const=ARQUIVO_PERFIL, metavar='ARQUIVO',
+                        help=f"mede cada etapa da carga e cada consulta (com EXPLAIN ANALYZE) e grava o relatório em JSON (padrão: {ARQUIVO_PERFIL})")
+
+# Subcomandos; sem subcomando, o prog.py executa 'run' (carga seguida do relatório)
+COMANDOS = ['load', 'report', 'query', 'bench', 'run']
+
+def main(argv=None):
+    """
+    Função principal que orquestra todo o processo.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] not in COMANDOS + ['-h', '--help']:
+        argv = ['run'] + argv
+
+    parser = argparse.ArgumentParser(description="Carrega os dados do ENADE e do IDEB/SAEB e gera os relatórios.")
+    subparsers = parser.add_subparsers(dest='comando', metavar='COMANDO')
+    parser_load = subparsers.add_parser('load', help="carrega os arquivos de origem no banco")
+    adicionar_opcoes_carga(parser_load)
+    adicionar_opcoes_execucao(parser_load)
+    parser_report = subparsers.add_parser('report', help="gera o relatório a partir do banco já carregado (somente leitura)")
+    adicionar_opcoes_consultas(parser_report)
+    adicionar_opcoes_exportacao(parser_report)
+    adicionar_opcoes_execucao(parser_report)
+    parser_query = subparsers.add_parser('query', help="executa uma consulta (nome do registro ou SQL) e exporta o resultado")
+    parser_query.add_argument('consulta', help=f"nome de uma consulta ({', '.join(c['nome'] for c in CONSULTAS)}) ou SQL")
+    parser_query.add_argument('--limite-memoria',
+                              help="teto de memória do DuckDB (ex.: '2GB'); acima dele os operadores usam disco")
+    adicionar_opcoes_consultas(parser_query, relatorio=False)
+    adicionar_opcoes_exportacao(parser_query, relatorio=False)
+    subparsers.add_parser('bench', help="executa o benchmark (opções: python prog.py bench -h)", add_help=False)
+    parser_run = subparsers.add_parser('run', help="carga seguida do relatório (padrão sem subcomando)")
+    adicionar_opcoes_carga(parser_run)
+    adicionar_opcoes_consultas(parser_run)
+    adicionar_opcoes_exportacao(parser_run)
+    adicionar_opcoes_execucao(parser_run)
+
+    if argv[0] == 'bench':
+        import benchmark
+        return benchmark.main(argv[1:])
+    args = parser.parse_args(argv)
+
+    if args.comando in ('report', 'query', 'run'):
+        try:
+            args.parametros = ler_parametros(args.param)
+        except ValueError as erro:
+            parser.error(str(erro))
+        if args.comando != 'query' or any(c['nome'] == args.consulta for c in CONSULTAS):
+            nomes = args.consultas if args.comando != 'query' else [args.consulta]
+            consultas = [c for c in CONSULTAS if not nomes or c['nome'] in nomes]
+            desconhecidos = set(args.parametros) - {nome for c in consultas for nome in c.get('parametros', {})}
+            if desconhecidos:
+                parser.error(f"parâmetros não usados pelas consultas: {', '.join(sorted(desconhecidos))}")
+
+    if args.comando == 'query' and args.saida in (None, '-') and args.formato == 'parquet':
+        parser.error("a saída em Parquet precisa de um arquivo (--saida ARQUIVO.parquet)")
+
+    inicio = datetime.now()
+    perfil = [] if getattr(args, 'perfil', None) else None
+    # Com --sombra a carga não abre o banco em uso para escrita (ver carregar_em_sombra)
+    sombra = getattr(args, 'sombra', False)
+    if sombra:
+        try:
+            carregar_em_sombra(args, perfil)
+        except ValueError as erro:
+            sys.exit(f"Carga não publicada: {erro}")
+    if args.comando != 'load' or not sombra:
+        try:
+            con = conectar(escrita=args.comando in ('load', 'run') and not sombra, limite_memoria=args.limite_memoria)
+        except FileNotFoundError as erro:
+            parser.error(str(erro))
+        try:
+            if args.comando in ('load', 'run') and not sombra:
+                comando_load(con, args, perfil)
+                podar_lago(con)
+            if args.comando in ('report', 'run'):
+                comando_report(con, args, perfil)
+            if args.comando == 'query':
+                comando_query(con, args)
+        finally:
+            con.close()
+
+    if perfil is not None:
+        gravar_perfil(args.perfil, perfil, inicio, {k: v for k, v in vars(args).items() if k != 'parametros'})
+        print(f"\nRelatório de execução gravado em {args.perfil}")
+
 if __name__ == "__main__":
     main()